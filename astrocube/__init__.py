@@ -4,8 +4,10 @@ astrocube.DataCube: A python class to represent a radio astronomy data cube
 @author: Braden MacDonald
 '''
 import numpy as np
-import pywcs
-import scipy.stats
+from astrocube import profiling
+# pywcs and scipy.stats are slow to import, so they are only imported when
+# first needed. This keeps "import astrocube" fast for scripts that don't use
+# them (see benchmarks/import_time.py).
 
 
 class DataCube:
@@ -17,30 +19,57 @@ class DataCube:
         Also can calculate the standard deviation of the noise for any
         data pixel coordinate. """
  
-    def __init__(self, fits_filename_or_hdu, hdu_index = 0, calc_noise_dev = True):
+    def __init__(self, fits_filename_or_hdu, hdu_index = 0, calc_noise_dev = True, cache = None, dtype = None):
         '''
         fits_filename_or_hdu: Either the path to a FITS file, or an HDU
         object loaded using PyFITS
         
         hdu_index: if a filename is given, this is which HDU to use
+        
+        cache: Optionally, a DerivedProductCache (see astrocube.cache), or the
+        path to a cache directory, or True to use the default cache directory.
+        Derived products such as noise_dev_xy will then be saved to disk and
+        re-used the next time the same cube is opened.
+        
+        dtype: the working precision for the data, e.g. numpy.float32 to use
+        half the memory of float64 data. By default, the dtype PyFITS gives
+        for the file is kept (float32 for scaled 16-bit integer data).
         '''
         if type(fits_filename_or_hdu) == str:
             import pyfits
-            hdulist = pyfits.open(fits_filename_or_hdu)
-            hdu = hdulist[hdu_index]
+            with profiling.timer("DataCube.open"):
+                hdulist = pyfits.open(fits_filename_or_hdu)
+                hdu = hdulist[hdu_index]
+            self._filename = fits_filename_or_hdu
         else:
             # Assume the argument given is a HDU object
             hdu = fits_filename_or_hdu
+            self._filename = None
+        self._hdu_index = hdu_index
+        
+        if cache is None or cache is False:
+            self._cache = None
+        else:
+            from astrocube.cache import DerivedProductCache
+            if isinstance(cache, DerivedProductCache):
+                self._cache = cache
+            else:
+                self._cache = DerivedProductCache(None if cache is True else cache)
+        self._source_id = None # Identifies the file/data for the cache; computed on demand
         
         self._header = hdu.header
         
         if not self._header.get("NAXIS", 0) == 3:
             raise Exception("This does not seem to be a valid data cube. It should be a 3-axis FITS file.")
+        with profiling.timer("DataCube.read_data"):
+            hdu_data = hdu.data # PyFITS reads the data from the file on first access
         self.object_name = self._header.get("OBJECT", "?")
         self.line_name = self._header.get("LINENAME", "?")
         
         # Now use pywcs to interpret the coordinates and re-index the array to a standardized (RA, DEC, VEL) zero-based index
-        self._wcs = pywcs.WCS(self._header)
+        import pywcs # (Imported here rather than at the top so that "import astrocube" stays fast; not timed)
+        with profiling.timer("DataCube.wcs"):
+            self._wcs = pywcs.WCS(self._header)
         if self._wcs.wcs.lat != -1 and self._wcs.wcs.lngtyp == 'RA' and self._wcs.wcs.lattyp == 'DEC':
             self.has_coords = True
             # Set up use of PyWCS:
@@ -49,12 +78,18 @@ class DataCube:
             self._index_dec = self._wcs.wcs.lat
             self._index_vel = self._wcs.wcs.spec
             last_axis = 2 # index of the third axis is 2 - we need this in order to reverse the FITS axis order
-            self.data = hdu.data.transpose((last_axis-self._wcs.wcs.lng, last_axis-self._wcs.wcs.lat, last_axis-self._wcs.wcs.spec)) # longitude index = right ascension; latitude index = declination, then spectral
+            self._fits_axes = (last_axis-self._wcs.wcs.lng, last_axis-self._wcs.wcs.lat, last_axis-self._wcs.wcs.spec) # longitude index = right ascension; latitude index = declination, then spectral
+            with profiling.timer("DataCube.transpose"):
+                self.data = hdu_data.transpose(self._fits_axes)
         else:
             # This data cube has no coordinates PyWCS can use
             self.has_coords = False
             self._wcs = None
-            self.data = hdu.data
+            self._fits_axes = (0, 1, 2)
+            self.data = hdu_data
+        if dtype is not None and self.data.dtype != dtype:
+            with profiling.timer("DataCube.astype"):
+                self.data = self.data.astype(dtype)
 
         
         if calc_noise_dev:
@@ -62,6 +97,7 @@ class DataCube:
         else:
             self.noise_dev, self.noise_dev_xy = None, None
     
+    @profiling.timed("DataCube.calc_noise_dev")
     def calc_noise_dev(self, iterations = 3, signal_threshold = 4, noise_slice_z = None, compute_spectral_variation = False):
         
         '''
@@ -84,6 +120,16 @@ class DataCube:
         iteration AND have set compute_spectral_variation = True. 
         '''
         
+        # Check if this has already been computed for this cube, with the same parameters:
+        cache_key = None
+        if self._cache is not None and noise_slice_z is None and not compute_spectral_variation:
+            cache_key = self._cache_key(product="noise_dev", iterations=iterations, signal_threshold=signal_threshold, dtype=str(self.data.dtype))
+            cached_xy = self._cache.get(cache_key, "noise_dev_xy")
+            if cached_xy is not None:
+                self.noise_dev_xy = cached_xy
+                self.noise_dev = np.expand_dims(self.noise_dev_xy, 2) * np.ones(self.data.shape[2], dtype=self.data.dtype)
+                return
+        
         if noise_slice_z is None:
             data_cropped = self.data
         else:
@@ -92,16 +138,23 @@ class DataCube:
             data_cropped = noise_slice_z.copy()
         
         # Calculate the distribution of noise in the cube:
-        self.noise_dev_xy = _mad(data_cropped, axis=2) # Use median absolute deviation to estimate sigma
+        with profiling.timer("calc_noise_dev.mad"):
+            self.noise_dev_xy = _mad(data_cropped, axis=2) # Use median absolute deviation to estimate sigma
         
         if iterations > 1:
             # Now iterate to refine this noise sigma estimate:
             self.noise_dev = np.expand_dims(self.noise_dev_xy, 2) # Add another dimension so we can multiply 3 lines below with broadcasting
-            data_cropped = self.data.copy() # We don't want to use masked arrays (feature-poor) or modify self.data directly so make a copy
+            with profiling.timer("calc_noise_dev.copy"):
+                data_cropped = self.data.copy() # We don't want to use masked arrays (feature-poor) or modify self.data directly so make a copy
             for _ in range(1, iterations):
-                data_cropped[data_cropped > signal_threshold*self.noise_dev] = np.nan # Ignore this data point
+                profiling.count("calc_noise_dev.iterations")
+                # Approximate peak memory use: the copy, self.noise_dev, the boolean mask, and the |data - median| temporary in _mad:
+                profiling.record_max("calc_noise_dev.peak_bytes", 2*data_cropped.nbytes + data_cropped.size + self.noise_dev.nbytes)
+                with profiling.timer("calc_noise_dev.clip"):
+                    data_cropped[data_cropped > signal_threshold*self.noise_dev] = np.nan # Ignore this data point
                 
-                self.noise_dev_xy = _mad(data_cropped, axis=2) # Use median absolute deviation to estimate sigma
+                with profiling.timer("calc_noise_dev.mad"):
+                    self.noise_dev_xy = _mad(data_cropped, axis=2) # Use median absolute deviation to estimate sigma
                 
                 if compute_spectral_variation:
                     self.noise_dev_z = _mad(data_cropped.reshape(-1, data_cropped.shape[2]), axis=0)
@@ -113,16 +166,34 @@ class DataCube:
                     raise Exception("Spectrally varying noise has not been implemented.")
                     
                     self.noise_dev = np.expand_dims(self.noise_dev_xy, 2) * self.noise_dev_z
+                    import scipy.stats
                     self.noise_dev /= scipy.stats.nanmean(self.noise_dev_z)
                 else:
                     self.noise_dev = np.expand_dims(self.noise_dev_xy, 2) * np.ones(self.data.shape[2], dtype=self.data.dtype)
         else:
             self.noise_dev = np.expand_dims(self.noise_dev_xy, 2) * np.ones(self.data.shape[2], dtype=self.data.dtype)
+        
+        if cache_key is not None:
+            self._cache.put(cache_key, "noise_dev_xy", self.noise_dev_xy)
+    
+    def _cache_key(self, **params):
+        '''
+        Returns the key used to store derived products of this cube in the
+        cache. params should include the name of the product and any parameters
+        that affect its value.
+        '''
+        if self._source_id is None:
+            if self._filename is not None:
+                self._source_id = self._cache.source_id(fits_filename=self._filename) + ":{0}".format(self._hdu_index)
+            else:
+                self._source_id = self._cache.source_id(data=self.data)
+        return self._cache.make_key(self._source_id, self._header, **params)
     
     def __str__(self):
         if self.noise_dev == None:
             sigma = "not computed"
         else:
+            import scipy.stats
             sigma = scipy.stats.nanmean(self.noise_dev.ravel())
         dmin,dmax = np.nanmin(self.data), np.nanmax(self.data)
         return ("DataCube {ln} spectral line map of {o}. "
@@ -132,6 +203,26 @@ class DataCube:
     def shape(self):
         """ Returns a tuple giving the sizes of each axis """
         return self.data.shape
+    def write_quantized(self, filename, step_fraction = 0.1):
+        """
+        Save the cube as a FITS file of 16-bit integers (with BSCALE/BZERO),
+        which is 2-4x smaller than float data. The quantization step is
+        step_fraction times the smallest value of noise_dev_xy, so the error
+        introduced is negligible compared to the noise. If filename ends in
+        ".gz", the file is also gzip-compressed. See astrocube.quantize.
+        Returns the quantization step used.
+        """
+        from astrocube.quantize import write_quantized
+        return write_quantized(self, filename, step_fraction)
+    @property
+    def lazy(self):
+        """
+        Lazily-evaluated versions of this cube's arrays, for memory-efficient
+        arithmetic, e.g. ((cube.lazy.data / cube.lazy.noise_dev > 3) * cube.lazy.data).sum()
+        See astrocube.lazy for details.
+        """
+        from astrocube.lazy import LazyCube
+        return LazyCube(self)
     def point_coords(self,x,y,z):
         """
         Given the 0-based coordinate of a point in the data cube, this will return a tuple 
@@ -197,6 +288,47 @@ class DataCube:
             return round(result, decimals)
         else:
             return result
+    def points_coords(self, x, y, z):
+        """
+        A vectorized version of point_coords: given arrays of 0-based x, y and
+        z coordinates, returns a tuple of arrays (ra, dec, vel) with ra,dec in
+        degrees and vel in km/s.
+        """
+        if not self._wcs:
+            raise Exception("This FITS file has no useable coordinate data.")
+        x, y, z = np.broadcast_arrays(*[np.asarray(c, np.float_) for c in (x, y, z)])
+        raw_coords = np.empty((x.size, 3), np.float_)
+        raw_coords[:, self._index_ra] = x.ravel()
+        raw_coords[:, self._index_dec] = y.ravel()
+        raw_coords[:, self._index_vel] = z.ravel()
+        sky = self._wcs.all_pix2sky(raw_coords, 0)
+        return (sky[:, self._index_ra].reshape(x.shape), sky[:, self._index_dec].reshape(x.shape), sky[:, self._index_vel].reshape(x.shape)/1000)
+    def pixel_coords(self, ra, dec, vel):
+        """
+        The inverse of points_coords: given sky coordinates (ra,dec in degrees,
+        vel in km/s; scalars or arrays), returns a tuple of arrays (x,y,z)
+        giving the 0-based (fractional) coordinates within the data cube.
+        """
+        if not self._wcs:
+            raise Exception("This FITS file has no useable coordinate data.")
+        ra, dec, vel = np.broadcast_arrays(*[np.asarray(c, np.float_) for c in (ra, dec, vel)])
+        sky = np.empty((ra.size, 3), np.float_)
+        sky[:, self._index_ra] = ra.ravel()
+        sky[:, self._index_dec] = dec.ravel()
+        sky[:, self._index_vel] = vel.ravel()*1000
+        pix = self._wcs.wcs_sky2pix(sky, 0)
+        return (pix[:, self._index_ra].reshape(ra.shape), pix[:, self._index_dec].reshape(ra.shape), pix[:, self._index_vel].reshape(ra.shape))
+    def fit_gaussians(self, ncomponents = 1, snr_threshold = 3, max_iter = 50, tile_size = None, processes = None):
+        """
+        Fit ncomponents Gaussians to the spectrum at every (x,y) position in
+        the cube, using self.noise_dev to weight the data. Spectra that never
+        rise above snr_threshold*noise are skipped.
+        Returns a GaussianFitResult with maps of the fitted amplitude, center
+        and width (in channels) and their uncertainties.
+        See astrocube.linefit for details.
+        """
+        from astrocube.linefit import fit_gaussians
+        return fit_gaussians(self, ncomponents=ncomponents, snr_threshold=snr_threshold, max_iter=max_iter, tile_size=tile_size, processes=processes)
 
 # Helper methods:
 def _deg2hms(deg):
@@ -222,9 +354,15 @@ def _mad(data, axis=0, scale = (1 / 0.6745)):
     be 1 / 0.6745 = 1.4826
     
     median(abs(a - median(a))) * scale
+    
+    If data is floating point, the result has the same dtype as data.
     '''
     # Compute initial medians. nanmedian reduces the dimensionality of data, so
     # expand_dims is needed so that the result can be broadcast across the 
     # original data cube during subtraction.
+    import scipy.stats
     medians = np.expand_dims(scipy.stats.nanmedian(data, axis), axis)
-    return scipy.stats.nanmedian(np.fabs(data - medians), axis) * scale
+    result = scipy.stats.nanmedian(np.fabs(data - medians), axis) * scale
+    if np.issubdtype(data.dtype, np.floating):
+        result = np.asarray(result, dtype=data.dtype) # Don't promote float32 data to float64
+    return result
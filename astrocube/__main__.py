@@ -0,0 +1,64 @@
+'''
+Headless command-line interface for scripted use, without GTK or matplotlib:
+
+    python -m astrocube info cube.fits [more.fits ...]
+    python -m astrocube stats [--no-noise] [--float32] [--cache] cube.fits ...
+
+"info" only reads the FITS headers, so it is fast and does not need pywcs or
+scipy. "stats" loads each cube and prints its intensity range and noise.
+
+@author: Braden MacDonald
+'''
+import argparse
+import sys
+
+
+def info(filename, hdu_index):
+    ''' Print a summary of a FITS cube's header '''
+    import pyfits
+    header = pyfits.getheader(filename, hdu_index)
+    naxis = header.get("NAXIS", 0)
+    axes = ["{0} {1}".format(header.get("NAXIS{0}".format(i), "?"), header.get("CTYPE{0}".format(i), "")).strip() for i in range(1, naxis+1)]
+    print("{f}: {ln} spectral line map of {o}. BITPIX={bitpix}, axes: {axes}".format(
+          f=filename, ln=header.get("LINENAME", "?"), o=header.get("OBJECT", "?"), bitpix=header.get("BITPIX", "?"), axes=", ".join(axes)))
+
+
+def stats(filename, hdu_index, calc_noise_dev, dtype, cache):
+    ''' Load a cube and print its basic statistics '''
+    import numpy as np
+    from astrocube import DataCube
+    cube = DataCube(filename, hdu_index=hdu_index, calc_noise_dev=calc_noise_dev, cache=cache, dtype=dtype)
+    if cube.noise_dev_xy is None:
+        sigma = "not computed"
+    else:
+        noise = np.asarray(cube.noise_dev_xy)
+        sigma = noise[np.isfinite(noise)].mean()
+    print("{f}: {ln} spectral line map of {o}. Shape {shape}, intensity {dmin} to {dmax}, mean noise deviation {sigma}".format(
+          f=filename, ln=cube.line_name, o=cube.object_name, shape=cube.shape(), dmin=np.nanmin(cube.data), dmax=np.nanmax(cube.data), sigma=sigma))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="python -m astrocube", description="Inspect radio astronomy data cubes without a GUI")
+    parser.add_argument("command", choices=["info", "stats"])
+    parser.add_argument("filenames", nargs="+", metavar="FILE")
+    parser.add_argument("--hdu", type=int, default=0, help="which HDU to use (default: 0)")
+    parser.add_argument("--no-noise", action="store_true", help="stats: don't compute the noise deviation")
+    parser.add_argument("--float32", action="store_true", help="stats: load the data as 32-bit floats")
+    parser.add_argument("--cache", action="store_true", help="stats: cache the noise deviation on disk (see astrocube.cache)")
+    args = parser.parse_args(argv)
+
+    status = 0
+    for filename in args.filenames:
+        try:
+            if args.command == "info":
+                info(filename, args.hdu)
+            else:
+                stats(filename, args.hdu, not args.no_noise, "float32" if args.float32 else None, args.cache or None)
+        except Exception as e:
+            print("{f}: ERROR: {err}".format(f=filename, err=e))
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
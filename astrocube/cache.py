@@ -0,0 +1,150 @@
+'''
+astrocube.cache: An on-disk cache for products derived from a data cube
+(e.g. noise_dev_xy), so that they don't need to be recomputed every time
+the same cube is opened.
+
+@author: Braden MacDonald
+'''
+import errno
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+
+def default_cache_dir():
+    ''' The directory used when a DataCube is created with cache=True '''
+    if os.environ.get("ASTROCUBE_CACHE_DIR"):
+        return os.environ["ASTROCUBE_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "astrocube")
+
+
+class DerivedProductCache:
+    """ A directory of derived data products (numpy arrays). Each product is
+        stored as a .npy file so that it can be memory-mapped when read back.
+        Entries are identified by a key (see make_key) plus a product name
+        such as "noise_dev_xy". When the total size of the cache exceeds
+        max_bytes, the least recently used products are deleted. """
+
+    suffix = ".npy"
+
+    def __init__(self, directory=None, max_bytes=1024**3):
+        '''
+        directory: where to store the cached products. Defaults to
+        default_cache_dir()
+
+        max_bytes: the maximum total size of the cache, in bytes
+        '''
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def source_id(fits_filename=None, data=None):
+        '''
+        Returns a string that identifies the contents of a cube. If the cube
+        was loaded from a file, the file's path, size and modification time are
+        used (cheap). Otherwise, a hash of the data array itself is used.
+        '''
+        if fits_filename is not None:
+            st = os.stat(fits_filename)
+            return "file:{path}:{size}:{mtime!r}".format(path=os.path.abspath(fits_filename), size=st.st_size, mtime=st.st_mtime)
+        digest = hashlib.sha1(str(data.shape).encode("ascii") + str(data.dtype).encode("ascii"))
+        for plane in data: # Hash one plane at a time to avoid copying the whole (possibly non-contiguous) cube
+            digest.update(np.ascontiguousarray(plane).view(np.uint8))
+        return "data:" + digest.hexdigest()
+
+    @staticmethod
+    def make_key(source_id, header, **params):
+        '''
+        Combine the identity of a cube (see source_id), its FITS header, and
+        any parameters used to compute a product into a single key string.
+        '''
+        digest = hashlib.sha1(source_id.encode("utf-8"))
+        digest.update(str(header).encode("utf-8", "replace"))
+        for name in sorted(params):
+            digest.update("{0}={1!r};".format(name, params[name]).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key, product):
+        return os.path.join(self.directory, "{key}.{product}{suffix}".format(key=key, product=product, suffix=self.suffix))
+
+    def get(self, key, product, mmap_mode='c'):
+        '''
+        Returns the cached array for the given key and product name, or None if
+        it is not in the cache. By default, the array is memory-mapped
+        copy-on-write rather than read into memory, so it can be modified like
+        a freshly computed array without changing the cached file.
+        '''
+        path = self._path(key, product)
+        try:
+            result = np.load(path, mmap_mode=mmap_mode)
+        except (IOError, OSError, ValueError):
+            return None # Missing, or a partially-written/corrupt file
+        try:
+            os.utime(path, None) # Mark this entry as recently used
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, product, array):
+        '''
+        Store an array in the cache, then evict old entries if the cache has
+        grown larger than max_bytes.
+        '''
+        path = self._path(key, product)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asanyarray(array))
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path) # rename() will not replace an existing file on Windows
+            os.rename(tmp_path, path) # Atomic, so readers never see a partially written file
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        ''' Returns a list of (last_used_time, size_in_bytes, path) for each cached product, oldest first '''
+        result = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # Deleted by another process
+            result.append((st.st_mtime, st.st_size, path))
+        result.sort()
+        return result
+
+    def size(self):
+        ''' The total size of all products in the cache, in bytes '''
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        ''' Delete least recently used products until the cache is no bigger than max_bytes '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        ''' Delete everything in the cache '''
+        self.evict(max_bytes=0)
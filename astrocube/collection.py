@@ -0,0 +1,310 @@
+'''
+astrocube.collection: Process many data cubes in parallel, e.g. all of the
+fields in a survey.
+
+@author: Braden MacDonald
+'''
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import numpy as np
+
+from astrocube import DataCube
+
+
+class CubeResult:
+    """ The outcome of processing one cube in a CubeCollection. If processing
+        failed, .error is a string describing the problem and .summary is
+        empty; the rest of the batch is not affected. """
+    def __init__(self, index, source, summary=None, noise_dev_xy=None, error=None, elapsed=0.0):
+        self.index = index # Position of this cube in the list given to CubeCollection
+        self.source = source # File name, or a description of the HDU
+        self.summary = summary or {}
+        self.noise_dev_xy = noise_dev_xy # Only set if CubeCollection was created with keep_noise=True
+        self.error = error
+        self.elapsed = elapsed # Seconds spent processing this cube
+    @property
+    def ok(self):
+        return self.error is None
+    def __str__(self):
+        if self.ok:
+            return "{src}: {n}".format(src=self.source, n=self.summary.get("object_name", "?"))
+        return "{src}: FAILED ({err})".format(src=self.source, err=self.error.strip().splitlines()[-1])
+
+
+class CubeCollection:
+    """ A list of data cubes (FITS files and/or HDUs) which are loaded and
+        analyzed in worker processes, one per cube. For each cube, the noise
+        deviation, basic statistics, and coordinates are computed.
+        Use process() to get results as each cube finishes, or run() to wait
+        for all of them. """
+
+    # calc_noise_dev makes several full-size copies of the cube, so a worker
+    # needs roughly this many times the size of the data in memory:
+    working_set_factor = 4
+
+    def __init__(self, sources, hdu_index = 0, processes = None, memory_limit = None,
+                 calc_noise_dev = True, noise_params = None, cache = None, keep_noise = False, timeout = None):
+        '''
+        sources: a list of FITS file names (or path objects) and/or HDU objects
+        loaded using PyFITS
+
+        hdu_index: for file names, which HDU to use
+
+        processes: the maximum number of cubes to process at once. Defaults to
+        the number of CPUs. Use 1 to process everything in this process.
+
+        memory_limit: if given, the approximate number of bytes that all cubes
+        being processed at once may use. Cubes will wait for others to finish
+        if starting them would exceed this (but a cube larger than the limit
+        will still be processed, on its own).
+
+        noise_params: a dict of keyword arguments for DataCube.calc_noise_dev
+
+        cache: passed on to DataCube (see astrocube.cache)
+
+        keep_noise: set True to send each cube's noise_dev_xy array back in
+        its CubeResult
+
+        timeout: if given, a cube whose worker process has been running for
+        longer than this many seconds is terminated and reported as failed.
+        Cubes whose worker process dies, e.g. killed for running out of
+        memory, are always reported as failed. (Neither applies when
+        processes is 1.)
+        '''
+        self.sources = list(sources)
+        self.hdu_index = hdu_index
+        self.processes = processes or multiprocessing.cpu_count()
+        self.memory_limit = memory_limit
+        self.calc_noise_dev = calc_noise_dev
+        self.noise_params = noise_params or {}
+        self.cache = cache
+        self.keep_noise = keep_noise
+        self.timeout = timeout
+        self.results = []
+        self._estimates = {} # index -> estimated bytes, so each header is only read once
+
+    def __len__(self):
+        return len(self.sources)
+
+    def _job(self, index):
+        ''' Returns the (picklable) arguments for _process_cube for the given cube '''
+        source = self.sources[index]
+        filename = _filename(source)
+        if filename is not None:
+            source = filename
+        else:
+            # HDU objects can't always be pickled, so just send the parts DataCube needs:
+            source = _HDU(source.header, source.data)
+        return (index, source, self.hdu_index, self.calc_noise_dev, self.noise_params, self.cache, self.keep_noise)
+
+    def _failure(self, index, elapsed = 0.0, error = None):
+        ''' A CubeResult for a cube that failed outside of _process_cube; describes the current exception by default '''
+        if error is None:
+            error = "".join(traceback.format_exception(*sys.exc_info()))
+        return CubeResult(index, str(self.sources[index]), error=error, elapsed=elapsed)
+
+    def _estimate_bytes(self, index):
+        ''' Estimate how much memory processing the given cube will need '''
+        if index not in self._estimates:
+            source = self.sources[index]
+            filename = _filename(source)
+            try:
+                if filename is not None:
+                    import pyfits
+                    header = pyfits.getheader(filename, self.hdu_index)
+                    nbytes = abs(header.get("BITPIX", -64)) // 8
+                    if header.get("BITPIX", -64) > 0 or "BSCALE" in header or "BZERO" in header:
+                        # PyFITS returns scaled (and DataCube converts) integer data as at least float32:
+                        nbytes = max(nbytes, 4)
+                    for axis in range(1, header.get("NAXIS", 0) + 1):
+                        nbytes *= header.get("NAXIS{0}".format(axis), 1)
+                else:
+                    nbytes = source.data.nbytes
+            except Exception:
+                nbytes = 0 # Unreadable; the worker will report the error
+            self._estimates[index] = nbytes * self.working_set_factor
+        return self._estimates[index]
+
+    def process(self):
+        '''
+        A generator which yields a CubeResult for each cube, in the order that
+        they finish processing. All results are also saved in self.results.
+        '''
+        self.results = []
+        if self.processes == 1:
+            for i in range(len(self.sources)):
+                try:
+                    result = _process_cube(self._job(i))
+                except Exception:
+                    result = self._failure(i)
+                self.results.append(result)
+                yield result
+            return
+
+        pending = list(range(len(self.sources)))
+        in_flight = {} # index -> (estimated bytes, worker Process, connection to receive its result from, time started)
+        try:
+            while pending or in_flight:
+                # Start as many cubes as the process and memory limits allow:
+                while pending and len(in_flight) < self.processes:
+                    nbytes = self._estimate_bytes(pending[0])
+                    in_flight_bytes = sum(b for b, _, _, _ in in_flight.values())
+                    if in_flight and self.memory_limit is not None and in_flight_bytes + nbytes > self.memory_limit:
+                        break
+                    index = pending.pop(0)
+                    try:
+                        receiver, sender = multiprocessing.Pipe(duplex=False)
+                        worker = multiprocessing.Process(target=_worker, args=(self._job(index), sender))
+                        worker.daemon = True
+                        worker.start()
+                        sender.close() # Only the worker writes to it; now receiver sees EOF if the worker dies
+                    except Exception:
+                        result = self._failure(index)
+                        self.results.append(result)
+                        yield result
+                        continue
+                    in_flight[index] = (nbytes, worker, receiver, time.time())
+                finished = False
+                for index in sorted(in_flight):
+                    _, worker, receiver, started = in_flight[index]
+                    if receiver.poll():
+                        try:
+                            result = receiver.recv()
+                        except EOFError: # Exited without sending a result
+                            worker.join()
+                            result = self._failure(index, time.time() - started, self._exit_error(worker))
+                    elif self.timeout is not None and time.time() - started > self.timeout:
+                        worker.terminate()
+                        result = self._failure(index, time.time() - started, "Timed out after {0} seconds".format(self.timeout))
+                    else:
+                        continue
+                    del in_flight[index]
+                    worker.join()
+                    receiver.close()
+                    finished = True
+                    self.results.append(result)
+                    yield result
+                if not finished:
+                    time.sleep(0.01)
+        finally:
+            for _, worker, receiver, _ in in_flight.values(): # In case the caller stopped iterating early
+                worker.terminate()
+                worker.join()
+                receiver.close()
+
+    @staticmethod
+    def _exit_error(worker):
+        ''' Describes why a worker process exited without sending its result '''
+        if worker.exitcode is not None and worker.exitcode < 0:
+            return "The worker process processing this cube was killed by signal {0} (was it out of memory?)".format(-worker.exitcode)
+        return "The worker process processing this cube died (exit code {0})".format(worker.exitcode)
+
+    def run(self):
+        ''' Process all cubes, and return the list of CubeResults in the original order of the cubes '''
+        for _ in self.process():
+            pass
+        return sorted(self.results, key=lambda r: r.index)
+
+    summary_columns = [
+        # (heading, key in CubeResult.summary, format)
+        ("Source", "source", "{0}"),
+        ("Object", "object_name", "{0}"),
+        ("Line", "line_name", "{0}"),
+        ("Shape", "shape", "{0[0]}x{0[1]}x{0[2]}"),
+        ("Min", "data_min", "{0:.4g}"),
+        ("Max", "data_max", "{0:.4g}"),
+        ("Mean noise", "noise_mean", "{0:.4g}"),
+        ("Peak (x,y,z)", "peak_xyz", "({0[0]},{0[1]},{0[2]})"),
+        ("RA (deg)", "center_ra", "{0:.5f}"),
+        ("Dec (deg)", "center_dec", "{0:.5f}"),
+        ("Velocity (km/s)", "vel_range", "{0[0]:.2f} to {0[1]:.2f}"),
+        ("Time (s)", "elapsed", "{0:.2f}"),
+        ("Status", "status", "{0}"),
+    ]
+
+    def summary_table(self):
+        '''
+        Returns a plain-text table summarizing every cube that has been
+        processed so far, one row per cube.
+        '''
+        rows = []
+        for r in sorted(self.results, key=lambda r: r.index):
+            values = dict(r.summary, source=os.path.basename(str(r.source)), elapsed=r.elapsed)
+            values["status"] = "ok" if r.ok else "FAILED: " + r.error.strip().splitlines()[-1]
+            row = []
+            for _, key, fmt in self.summary_columns:
+                value = values.get(key)
+                row.append("-" if value is None else fmt.format(value))
+            rows.append(row)
+        headings = [heading for heading, _, _ in self.summary_columns]
+        widths = [max([len(h)] + [len(row[i]) for row in rows]) for i, h in enumerate(headings)]
+        lines = ["  ".join(h.ljust(w) for h, w in zip(headings, widths))]
+        lines.append("  ".join("-"*w for w in widths))
+        for row in rows:
+            lines.append("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+        return "\n".join(lines)
+
+
+def _filename(source):
+    ''' If source is a file name or path object, returns it as a str, otherwise None '''
+    if hasattr(source, "__fspath__"): # e.g. pathlib.Path
+        source = source.__fspath__()
+    if isinstance(source, str):
+        return source
+    try:
+        if isinstance(source, unicode): # Python 2
+            return source.encode(sys.getfilesystemencoding() or "utf-8")
+    except NameError: # Python 3, where every str was handled above
+        pass
+    return None
+
+class _HDU:
+    """ A minimal stand-in for a PyFITS HDU, which DataCube can load from """
+    def __init__(self, header, data):
+        self.header = header
+        self.data = data
+    def __str__(self):
+        return "<HDU {0}>".format(self.header.get("OBJECT", "?"))
+
+
+def _worker(job, connection):
+    ''' The body of a worker process: process one cube and send back its CubeResult '''
+    result = _process_cube(job)
+    try:
+        connection.send(result)
+    except Exception:
+        # e.g. the result could not be pickled:
+        connection.send(CubeResult(result.index, result.source, error="".join(traceback.format_exception(*sys.exc_info())), elapsed=result.elapsed))
+    connection.close()
+
+def _process_cube(job):
+    ''' Load and analyze a single cube. Runs in a worker process, so must never raise. '''
+    index, source, hdu_index, calc_noise_dev, noise_params, cache, keep_noise = job
+    start = time.time()
+    try:
+        cube = DataCube(source, hdu_index=hdu_index, calc_noise_dev=False, cache=cache)
+        if calc_noise_dev:
+            cube.calc_noise_dev(**noise_params)
+        summary = {
+            "object_name": cube.object_name,
+            "line_name": cube.line_name,
+            "shape": cube.shape(),
+            "has_coords": cube.has_coords,
+            "data_min": float(np.nanmin(cube.data)),
+            "data_max": float(np.nanmax(cube.data)),
+            "peak_xyz": tuple(int(i) for i in np.unravel_index(np.nanargmax(cube.data), cube.data.shape)),
+        }
+        if cube.noise_dev_xy is not None:
+            noise = np.asarray(cube.noise_dev_xy)
+            summary["noise_mean"] = float(noise[np.isfinite(noise)].mean())
+        if cube.has_coords:
+            nx, ny, nz = cube.shape()
+            summary["center_ra"], summary["center_dec"], _ = cube.point_coords(nx//2, ny//2, 0)
+            summary["vel_range"] = (cube.velocity_at(0), cube.velocity_at(nz-1))
+        noise_dev_xy = np.array(cube.noise_dev_xy) if (keep_noise and cube.noise_dev_xy is not None) else None
+        return CubeResult(index, str(source), summary, noise_dev_xy, elapsed=time.time()-start)
+    except Exception:
+        return CubeResult(index, str(source), error="".join(traceback.format_exception(*sys.exc_info())), elapsed=time.time()-start)
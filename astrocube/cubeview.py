@@ -10,10 +10,12 @@ import gtk
 import matplotlib
 import numpy as np
 from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg, NavigationToolbar2GTKAgg
+from astrocube import profiling
 
 class CubeViewWidget(gtk.VBox):
 
     default_cmap = matplotlib.colors.LinearSegmentedColormap.from_list('astrocube', ['black', 'purple', 'darkblue', 'cyan', 'green', 'yellow', 'orange'])
+    highlight_dtype = np.float32 # dtype of the highlighter alpha arrays, which are the same size as the cube
     
     def __init__(self, cube, parent_window, cmap=None):
         gtk.VBox.__init__(self, False)
@@ -140,7 +142,7 @@ class CubeViewWidget(gtk.VBox):
         # Update any highlighters:
         for h in self._highlighters:
             h._generate_preimage()
-            h._hdata = np.zeros(self.cube.data.shape)
+            h._hdata = np.zeros(self.cube.data.shape, dtype=self.highlight_dtype)
         # The following will ensure the x,y,z values are valid
         # and will trigger a re-rendering of the plot:
         self.x, self.y, self.z = self._x, self._y, self._z
@@ -198,9 +200,12 @@ class CubeViewWidget(gtk.VBox):
                 self.yline.set_ydata([self._y, self._y])
                 self.last_drawn_y = self._y
             if self._z != self.last_drawn_z: # If z has changed since we last drew:
-                self.imgplot.set_data(self.cube.data[:,:,self._z].transpose(1,0))
+                with profiling.timer("CubeViewWidget.slice"):
+                    self.imgplot.set_data(self.cube.data[:,:,self._z].transpose(1,0))
                 self.last_drawn_z = self._z
-            self.fig.canvas.draw()
+            with profiling.timer("CubeViewWidget.draw"):
+                self.fig.canvas.draw()
+            profiling.count("CubeViewWidget.redraws")
             self.needs_redraw = False
         return True
     
@@ -223,7 +228,7 @@ class CubeViewWidget(gtk.VBox):
             self.cube_view = cube_view
             # Create an RGBA array that we'll pass to imshow:
             self._generate_preimage()
-            self._hdata = np.zeros(cube_view.cube.data.shape) 
+            self._hdata = np.zeros(cube_view.cube.data.shape, dtype=cube_view.highlight_dtype)
             self.imgplot = cube_view.axes.imshow(self._preimage)
             
         def highlight(self, new_mask):
@@ -231,12 +236,17 @@ class CubeViewWidget(gtk.VBox):
             Any new_mask should be a float or boolean ndarray with same shape as data.
             Any True values will get highlighted. Otherwise, values are treated
             as an alpha channel, so 1 = Fully opaque, 0 = Fully transparent 
+            new_mask may also be a LazyArray expression (see astrocube.lazy),
+            in which case only the slice being displayed is ever computed.
             """
             assert(new_mask.shape == self.cube_view.cube.data.shape)
             self._hdata = new_mask
             self._update_imgplot()
         def clear(self):
-            self._hdata.fill(0)
+            if isinstance(self._hdata, np.ndarray):
+                self._hdata.fill(0)
+            else: # A LazyArray
+                self._hdata = np.zeros(self.cube_view.cube.data.shape, dtype=self.cube_view.highlight_dtype)
             self._update_imgplot()
         def _update_imgplot(self, trigger_redraw=True):
             """ Called after highlight data has changed """
@@ -252,7 +262,7 @@ class CubeViewWidget(gtk.VBox):
             Create an RGBA array that we can pass to imshow.
             Note axis 0 in the image is axis 1 in our cube data
             """
-            self._preimage = np.zeros([self.cube_view.cube.data.shape[1],self.cube_view.cube.data.shape[0],4])
+            self._preimage = np.zeros([self.cube_view.cube.data.shape[1],self.cube_view.cube.data.shape[0],4], dtype=self.cube_view.highlight_dtype)
             self._preimage[:,:] = matplotlib.colors.colorConverter.to_rgba(self.color, alpha=0)
     
     class _AxisFormatter(matplotlib.ticker.Formatter):
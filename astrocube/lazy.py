@@ -0,0 +1,342 @@
+'''
+astrocube.lazy: Lazily evaluated arithmetic on data cubes.
+
+An expression such as (cube.data / cube.noise_dev > 3) * cube.data creates
+several temporary arrays the size of the whole cube. Writing the same thing
+with LazyArrays, e.g.
+
+    lz = cube.lazy
+    expr = (lz.data / lz.noise_dev > 3) * lz.data
+
+only records the operations. When a result is requested (evaluate(), a
+reduction such as sum(), or indexing), the whole expression is computed one
+chunk of the cube at a time, so temporaries are only ever chunk-sized.
+Reductions may also be taken along one axis, e.g. expr.sum(axis=2) for a
+moment-0 style map, which is likewise accumulated chunk by chunk.
+
+@author: Braden MacDonald
+'''
+from multiprocessing.pool import ThreadPool
+import itertools
+import threading
+import numpy as np
+
+
+# Size of the chunks that expressions are evaluated in. Small enough that
+# the temporaries of a typical expression fit in the CPU cache:
+default_chunk_bytes = 256*1024
+
+
+class LazyArray:
+    """ A node in an expression tree. Supports the usual elementwise
+        arithmetic, comparison and logical operators, plus numpy ufuncs via
+        apply(). Leaves wrap real arrays; all leaves of an expression must have
+        the same number of dimensions, but axes of length 1 broadcast. """
+
+    # Make numpy defer to our reflected operators (e.g. array * lazy_array
+    # calls __rmul__) instead of treating a LazyArray as an object scalar:
+    __array_priority__ = 1000
+    __array_ufunc__ = None # numpy 1.13+
+    # == and != build expressions, so LazyArrays can't be hashed:
+    __hash__ = None
+
+    def __init__(self, op, args, shape, dtype):
+        ''' Do not call this yourself; use lazy() to wrap an array '''
+        self._op = op # a numpy ufunc, or None for a leaf (args is then (array,))
+        self._args = args
+        self.shape = shape
+        self.dtype = dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __repr__(self):
+        return "<LazyArray shape={0} dtype={1}>".format(self.shape, self.dtype)
+
+    # Building expressions:
+
+    def apply(self, ufunc, *others):
+        ''' Record an elementwise numpy ufunc applied to this and any other arguments, e.g. x.apply(np.fabs) '''
+        return self._record(ufunc, (self,) + tuple(others))
+
+    def _rapply(self, ufunc, other):
+        return self._record(ufunc, (other, self))
+
+    def _record(self, ufunc, args):
+        args = tuple(_operand(a, self.ndim) for a in args)
+        shape = _broadcast_shape([a.shape for a in args if isinstance(a, LazyArray)])
+        # Promote the arguments' types, then let the ufunc decide the result type (e.g. bool for
+        # comparisons, float for dividing integers) from a single element of that type:
+        common = np.result_type(*[a.dtype if isinstance(a, LazyArray) else a for a in args])
+        dtype = ufunc(*[np.ones(1, common)]*len(args)).dtype
+        return LazyArray(ufunc, args, shape, dtype)
+
+    def __add__(self, other): return self.apply(np.add, other)
+    def __radd__(self, other): return self._rapply(np.add, other)
+    def __sub__(self, other): return self.apply(np.subtract, other)
+    def __rsub__(self, other): return self._rapply(np.subtract, other)
+    def __mul__(self, other): return self.apply(np.multiply, other)
+    def __rmul__(self, other): return self._rapply(np.multiply, other)
+    def __truediv__(self, other): return self.apply(np.true_divide, other)
+    def __rtruediv__(self, other): return self._rapply(np.true_divide, other)
+    __div__, __rdiv__ = __truediv__, __rtruediv__ # Python 2
+    def __pow__(self, other): return self.apply(np.power, other)
+    def __rpow__(self, other): return self._rapply(np.power, other)
+    def __neg__(self): return self.apply(np.negative)
+    def __abs__(self): return self.apply(np.fabs)
+    def __gt__(self, other): return self.apply(np.greater, other)
+    def __ge__(self, other): return self.apply(np.greater_equal, other)
+    def __lt__(self, other): return self.apply(np.less, other)
+    def __le__(self, other): return self.apply(np.less_equal, other)
+    def __eq__(self, other): return self.apply(np.equal, other)
+    def __ne__(self, other): return self.apply(np.not_equal, other)
+    def __and__(self, other): return self.apply(np.logical_and, other)
+    def __or__(self, other): return self.apply(np.logical_or, other)
+    def __invert__(self): return self.apply(np.logical_not)
+
+    def where(self, if_true, if_false):
+        ''' Like np.where(self, if_true, if_false) '''
+        if_true, if_false = _operand(if_true, self.ndim), _operand(if_false, self.ndim)
+        return LazyArray(np.where, (self, if_true, if_false),
+                         _broadcast_shape([a.shape for a in (self, if_true, if_false) if isinstance(a, LazyArray)]),
+                         np.result_type(*[a.dtype if isinstance(a, LazyArray) else np.asarray(a).dtype for a in (if_true, if_false)]))
+
+    # Evaluation:
+
+    def __getitem__(self, index):
+        '''
+        Returns the given part of the expression result, as a real array.
+        Only integers and slices are supported as indices. Only the data needed
+        is read and computed, so e.g. expr[:,:,z] is cheap.
+        '''
+        return _materialize(self._index(index))
+
+    def _index(self, index):
+        ''' Returns a new expression which applies index to every leaf '''
+        if not isinstance(index, tuple):
+            index = (index,)
+        if any(i is Ellipsis for i in index):
+            position = index.index(Ellipsis)
+            index = index[:position] + (slice(None),)*(self.ndim - len(index) + 1) + index[position+1:]
+        index = index + (slice(None),)*(self.ndim - len(index))
+        for i in index:
+            if not isinstance(i, (slice, int, np.integer)):
+                raise IndexError("LazyArray only supports integer and slice indices")
+        return self._map_leaves(lambda array: array[_leaf_index(index, array.shape)])
+
+    def _map_leaves(self, func):
+        if self._op is None:
+            array = func(self._args[0])
+            return LazyArray(None, (array,), array.shape, self.dtype)
+        args = tuple(a._map_leaves(func) if isinstance(a, LazyArray) else a for a in self._args)
+        return LazyArray(self._op, args, _broadcast_shape([a.shape for a in args if isinstance(a, LazyArray)]), self.dtype)
+
+    def _compute(self):
+        ''' Evaluate this (small) expression directly '''
+        if self._op is None:
+            return self._args[0]
+        return self._op(*[a._compute() if isinstance(a, LazyArray) else a for a in self._args])
+
+    def _chunks(self, chunk_bytes):
+        '''
+        Split the array into blocks (tuples of slices) such that evaluating the
+        expression over one block needs about chunk_bytes of temporaries. The
+        block covers whole trailing axes where possible; if even one plane is
+        too big, it is split along the next axes as well (down to single
+        elements of the last axis, if need be).
+        '''
+        if self.ndim == 0 or 0 in self.shape:
+            return [(slice(None),)*self.ndim]
+        element_bytes = 8 * self._count_nodes()
+        # Find the first axis along which a block of the trailing axes fits:
+        axis = 0
+        while axis < self.ndim - 1 and int(np.prod(self.shape[axis+1:])) * element_bytes > chunk_bytes:
+            axis += 1
+        n = max(int(chunk_bytes // (int(np.prod(self.shape[axis+1:])) * element_bytes)), 1)
+        ranges = [[slice(i, i+1) for i in range(length)] for length in self.shape[:axis]]
+        ranges.append([slice(start, min(start+n, self.shape[axis])) for start in range(0, self.shape[axis], n)])
+        ranges.extend([slice(None)] for _ in self.shape[axis+1:])
+        return list(itertools.product(*ranges))
+
+    def _count_nodes(self):
+        if self._op is None:
+            return 1
+        return 1 + sum(a._count_nodes() for a in self._args if isinstance(a, LazyArray))
+
+    def evaluate(self, out = None, chunk_bytes = None, threads = 1):
+        '''
+        Compute the result of the expression and store it in out (which may be
+        a numpy memmap, to write the result straight to disk). If out is not
+        given, a new array is allocated. Returns out.
+        threads: how many threads to use to evaluate chunks in parallel.
+        '''
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        elif out.shape != self.shape:
+            raise ValueError("out must have shape {0}".format(self.shape))
+        def compute_chunk(chunk):
+            out[chunk] = _materialize(self._index(chunk))
+        self._map_chunks(compute_chunk, chunk_bytes, threads)
+        return out
+
+    def _map_chunks(self, func, chunk_bytes, threads):
+        chunks = self._chunks(chunk_bytes or default_chunk_bytes)
+        if threads <= 1:
+            return [func(chunk) for chunk in chunks]
+        pool = ThreadPool(threads) # numpy releases the GIL during most elementwise operations
+        try:
+            return pool.map(func, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _reduce(self, chunk_func, combine, chunk_bytes, threads):
+        return combine(self._map_chunks(lambda chunk: chunk_func(_materialize(self._index(chunk))), chunk_bytes, threads))
+
+    def _reduce_axis(self, axis, chunk_func, ufuncs, chunk_bytes, threads):
+        '''
+        Reduce along one axis. chunk_func(values, axis) must return a tuple of
+        partial results for one chunk; the partial results of chunks which
+        differ only along axis are combined with the corresponding ufuncs
+        (e.g. np.add). Returns a list of arrays, one per ufunc.
+        '''
+        if axis < 0:
+            axis += self.ndim
+        if not 0 <= axis < self.ndim:
+            raise ValueError("axis {0} is out of bounds for an array of dimension {1}".format(axis, self.ndim))
+        shape = self.shape[:axis] + self.shape[axis+1:]
+        results = []
+        done = set() # The parts of the results that have been assigned a first value
+        lock = threading.Lock()
+        def reduce_chunk(chunk):
+            partials = chunk_func(_materialize(self._index(chunk)), axis)
+            where = chunk[:axis] + chunk[axis+1:]
+            key = tuple((s.start, s.stop) for s in where) # Chunks never partially overlap, so this identifies the part
+            with lock:
+                if not results:
+                    results.extend(np.empty(shape, np.asarray(p).dtype) for p in partials)
+                for result, partial, ufunc in zip(results, partials, ufuncs):
+                    if key in done:
+                        result[where] = ufunc(result[where], partial)
+                    else:
+                        result[where] = partial
+                done.add(key)
+        self._map_chunks(reduce_chunk, chunk_bytes, threads)
+        return results
+
+    # Reductions, each computed chunk by chunk. With axis=None (the default),
+    # they reduce over the whole array; otherwise along the given axis only.
+
+    def sum(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self._reduce_axis(axis, lambda c, a: (np.sum(c, axis=a),), (np.add,), chunk_bytes, threads)[0]
+        return self._reduce(np.sum, sum, chunk_bytes, threads)
+    def nansum(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self._reduce_axis(axis, lambda c, a: (np.nansum(c, axis=a),), (np.add,), chunk_bytes, threads)[0]
+        return self._reduce(np.nansum, sum, chunk_bytes, threads)
+    def count_nonzero(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self._reduce_axis(axis, lambda c, a: ((c != 0).sum(axis=a),), (np.add,), chunk_bytes, threads)[0]
+        return self._reduce(np.count_nonzero, sum, chunk_bytes, threads)
+    def max(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self._reduce_axis(axis, lambda c, a: (np.max(c, axis=a),), (np.maximum,), chunk_bytes, threads)[0]
+        return self._reduce(np.max, max, chunk_bytes, threads)
+    def min(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self._reduce_axis(axis, lambda c, a: (np.min(c, axis=a),), (np.minimum,), chunk_bytes, threads)[0]
+        return self._reduce(np.min, min, chunk_bytes, threads)
+    def nanmax(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None: # fmax ignores NaNs, and gives NaN only where every value is NaN
+            return self._reduce_axis(axis, lambda c, a: (np.fmax.reduce(c, axis=a),), (np.fmax,), chunk_bytes, threads)[0]
+        return self._reduce(lambda c: np.nanmax(c) if np.isfinite(c).any() else np.nan, _nan_combine(max), chunk_bytes, threads)
+    def nanmin(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self._reduce_axis(axis, lambda c, a: (np.fmin.reduce(c, axis=a),), (np.fmin,), chunk_bytes, threads)[0]
+        return self._reduce(lambda c: np.nanmin(c) if np.isfinite(c).any() else np.nan, _nan_combine(min), chunk_bytes, threads)
+    def mean(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            return self.sum(axis, chunk_bytes, threads) / float(self.shape[axis])
+        return self.sum(None, chunk_bytes, threads) / float(np.prod(self.shape))
+    def nanmean(self, axis = None, chunk_bytes = None, threads = 1):
+        if axis is not None:
+            totals, counts = self._reduce_axis(axis, lambda c, a: (np.nansum(c, axis=a), (~np.isnan(c)).sum(axis=a)),
+                                               (np.add, np.add), chunk_bytes, threads)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(counts > 0, totals / np.maximum(counts, 1).astype(np.float_), np.nan)
+        totals = self._reduce(lambda c: (np.nansum(c), (~np.isnan(c)).sum()),
+                              lambda results: [sum(r[i] for r in results) for i in (0, 1)], chunk_bytes, threads)
+        return totals[0] / float(totals[1]) if totals[1] else np.nan
+
+
+def lazy(array):
+    ''' Wrap a numpy array (or memmap) so that arithmetic on it is recorded rather than performed '''
+    array = np.asanyarray(array)
+    return LazyArray(None, (array,), array.shape, array.dtype)
+
+
+class LazyCube:
+    """ Access to the arrays of a DataCube as LazyArrays. Returned by
+        DataCube.lazy; use e.g. cube.lazy.data and cube.lazy.noise_dev """
+    def __init__(self, cube):
+        self._cube = cube
+    @property
+    def data(self):
+        return lazy(self._cube.data)
+    @property
+    def noise_dev(self):
+        ''' The noise deviation, as a broadcast of noise_dev_xy (so this doesn't require the full noise_dev array) '''
+        if self._cube.noise_dev_xy is None:
+            raise Exception("The noise deviation has not been computed. Call calc_noise_dev() first.")
+        return lazy(np.expand_dims(self._cube.noise_dev_xy, 2))
+
+
+def _operand(value, ndim):
+    '''
+    Wrap an array operand with lazy(), so that it is sliced into chunks like
+    the other leaves of the expression. Scalars are kept as they are. Arrays
+    with fewer dimensions get leading axes of length 1, as numpy would.
+    '''
+    if isinstance(value, LazyArray) or np.ndim(value) == 0:
+        return value
+    value = np.asanyarray(value)
+    if value.ndim < ndim:
+        value = value.reshape((1,)*(ndim - value.ndim) + value.shape)
+    return lazy(value)
+
+def _broadcast_shape(shapes):
+    result = list(shapes[0])
+    for shape in shapes[1:]:
+        if len(shape) != len(result):
+            raise ValueError("All arrays in a lazy expression must have the same number of dimensions")
+        for i, n in enumerate(shape):
+            if result[i] == 1:
+                result[i] = n
+            elif n != 1 and n != result[i]:
+                raise ValueError("Shapes {0} and {1} can not be broadcast together".format(tuple(result), shape))
+    return tuple(result)
+
+def _leaf_index(index, shape):
+    ''' Adapt an index for a leaf array, keeping any broadcast (length 1) axes '''
+    result = []
+    for i, n in zip(index, shape):
+        if n == 1 and not (isinstance(i, slice) and i == slice(None)):
+            result.append(0 if not isinstance(i, slice) else slice(None))
+        else:
+            result.append(i)
+    return tuple(result)
+
+def _materialize(expr):
+    ''' Compute a (small) expression into a real array with the expression's full shape '''
+    result = np.asarray(expr._compute())
+    if result.shape != expr.shape:
+        result = np.broadcast_to(result, expr.shape) if hasattr(np, "broadcast_to") else result * np.ones(expr.shape, result.dtype)
+    return result
+
+def _nan_combine(func):
+    def combine(results):
+        results = [r for r in results if not np.isnan(r)]
+        return func(results) if results else np.nan
+    return combine
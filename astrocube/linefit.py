@@ -0,0 +1,215 @@
+'''
+astrocube.linefit: Fit Gaussian line profiles to every spectrum in a data
+cube at once.
+
+Rather than calling an optimizer once per pixel, the Levenberg-Marquardt
+iterations are carried out on whole arrays of spectra with numpy, and the
+cube is split into tiles that are fitted in parallel threads.
+
+@author: Braden MacDonald
+'''
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+class GaussianFitResult:
+    """ Maps of the fitted parameters. amplitude, center and width (the
+        Gaussian sigma) have shape (nx, ny, ncomponents), as do their
+        uncertainties (amplitude_err etc.). center and width are in channels
+        (z pixels). Spectra that were not fitted (too faint, or the fit
+        failed) are NaN. """
+    def __init__(self, cube, params, errors, chi2_reduced, fitted):
+        self.cube = cube
+        self.ncomponents = params.shape[2] // 3
+        self.amplitude, self.center, self.width = params[:,:,0::3], params[:,:,1::3], params[:,:,2::3]
+        self.amplitude_err, self.center_err, self.width_err = errors[:,:,0::3], errors[:,:,1::3], errors[:,:,2::3]
+        self.chi2_reduced = chi2_reduced # shape (nx, ny)
+        self.fitted = fitted # boolean, shape (nx, ny)
+    def center_velocity(self):
+        ''' Returns the center of each component in km/s rather than in channels '''
+        return self.cube.points_coords(0, 0, self.center)[2]
+    def model(self):
+        ''' Returns a cube of the fitted model, with the same shape as cube.data '''
+        z = np.arange(self.cube.data.shape[2])
+        result = np.zeros(self.cube.data.shape)
+        for k in range(self.ncomponents):
+            a, c, w = [np.expand_dims(np.nan_to_num(p[:,:,k]), 2) for p in (self.amplitude, self.center, self.width)]
+            w = np.where(w == 0, 1, w)
+            result += a * np.exp(-(z - c)**2 / (2*w**2))
+        return result
+
+
+# Approximate memory that fitting one tile of spectra may use, per thread:
+default_tile_bytes = 16*1024**2
+
+def fit_gaussians(cube, ncomponents = 1, snr_threshold = 3, max_iter = 50, tolerance = 1e-4, tile_size = None, processes = None, tile_bytes = None):
+    '''
+    Fit ncomponents Gaussians to the spectrum (along z) at every (x, y)
+    position of the given DataCube. cube.noise_dev is used to weight each
+    channel; spectra whose peak is below snr_threshold times the noise are
+    not fitted. Initial guesses come from the intensity-weighted moments of
+    each spectrum.
+
+    Spectra are fitted in tiles using a pool of processes threads (default:
+    one per CPU). Unless tile_size (the number of spectra per tile) is given,
+    it is chosen so that each thread uses about tile_bytes of memory
+    (default_tile_bytes), i.e. fewer spectra per tile for longer spectra.
+
+    Returns a GaussianFitResult.
+    '''
+    if cube.noise_dev is None:
+        cube.calc_noise_dev()
+    nx, ny, nz = cube.data.shape
+    nparams = 3*ncomponents
+    params = np.empty((nx*ny, nparams))
+    params.fill(np.nan)
+    errors = params.copy()
+    chi2_reduced = np.empty(nx*ny)
+    chi2_reduced.fill(np.nan)
+    fitted = np.zeros(nx*ny, dtype=bool)
+    z = np.arange(nz, dtype=np.float_)
+    if tile_size is None:
+        # The Jacobian and the trial step's Jacobian dominate: 2*nparams values per channel,
+        # plus about 8 other arrays (data, noise, weights, models, ...) with one value per channel:
+        bytes_per_spectrum = nz * (2*nparams + 8) * 8
+        tile_size = max(int((tile_bytes or default_tile_bytes) // bytes_per_spectrum), 1)
+
+    def fit_tile(start):
+        stop = min(start + tile_size, nx*ny)
+        xs, ys = np.unravel_index(np.arange(start, stop), (nx, ny))
+        spectra = np.asarray(cube.data[xs, ys, :], dtype=np.float_)
+        sigma = np.asarray(cube.noise_dev[xs, ys, :], dtype=np.float_)
+        with np.errstate(invalid='ignore'):
+            bright = np.nanmax(np.where(np.isfinite(spectra), spectra / sigma, -np.inf), axis=1) >= snr_threshold
+        if not bright.any():
+            return
+        index = np.arange(start, stop)[bright]
+        p, err, chi2, ok = _fit_spectra(z, spectra[bright], sigma[bright], ncomponents, max_iter, tolerance)
+        params[index], errors[index], chi2_reduced[index], fitted[index] = p, err, chi2, ok
+
+    pool = ThreadPool(processes)
+    try:
+        pool.map(fit_tile, range(0, nx*ny, tile_size))
+    finally:
+        pool.close()
+        pool.join()
+    params[~fitted] = np.nan
+    errors[~fitted] = np.nan
+    return GaussianFitResult(cube, params.reshape(nx, ny, nparams), errors.reshape(nx, ny, nparams),
+                             chi2_reduced.reshape(nx, ny), fitted.reshape(nx, ny))
+
+
+def _model_and_jacobian(z, p):
+    '''
+    Evaluate the sum of Gaussians with parameters p (shape (N, 3*ncomponents),
+    ordered amplitude, center, width for each component) at channels z.
+    Returns the model (N, nz) and its Jacobian (N, nz, 3*ncomponents).
+    '''
+    model = np.zeros((p.shape[0], z.size))
+    jacobian = np.empty((p.shape[0], z.size, p.shape[1]))
+    for k in range(0, p.shape[1], 3):
+        a, c, w = p[:, k:k+1], p[:, k+1:k+2], p[:, k+2:k+3]
+        offset = z - c
+        g = np.exp(-offset**2 / (2*w**2))
+        model += a*g
+        jacobian[:, :, k] = g
+        jacobian[:, :, k+1] = a*g*offset / w**2
+        jacobian[:, :, k+2] = a*g*offset**2 / w**3
+    return model, jacobian
+
+
+def _initial_guess(z, spectra, sigma, ncomponents):
+    '''
+    Moment-based initial guesses: each component is placed at the peak of the
+    residual spectrum, with the center and width given by the first and
+    second moments of the contiguous run of channels above twice the noise
+    around that peak. (Using only that run keeps other lines in the spectrum
+    from pulling the guess away from this one.)
+    '''
+    p = np.empty((spectra.shape[0], 3*ncomponents))
+    residual = spectra.copy()
+    rows = np.arange(spectra.shape[0])
+    channels = np.arange(z.size)
+    for k in range(ncomponents):
+        peak = np.argmax(residual, axis=1)
+        above = residual > 2*sigma
+        # The first channel below 2 sigma on either side of the peak bounds the window:
+        below_left = ~above & (channels < peak[:, None])
+        below_right = ~above & (channels > peak[:, None])
+        left = np.where(below_left, channels, -1).max(axis=1) + 1
+        right = np.where(below_right, channels, z.size).min(axis=1)
+        window = (channels >= left[:, None]) & (channels < right[:, None])
+        signal = np.where(window & above, residual, 0)
+        total = signal.sum(axis=1)
+        safe_total = np.where(total > 0, total, 1)
+        center = np.where(total > 0, (signal*z).sum(axis=1) / safe_total, peak)
+        width = np.sqrt(np.where(total > 0, (signal*(z - center[:, None])**2).sum(axis=1) / safe_total, 1))
+        p[:, 3*k] = residual[rows, peak]
+        p[:, 3*k+1] = center
+        p[:, 3*k+2] = np.clip(width, 0.5, z.size/2.)
+        residual = residual - _model_and_jacobian(z, p[:, 3*k:3*k+3])[0]
+    return p
+
+
+def _fit_spectra(z, spectra, sigma, ncomponents, max_iter, tolerance):
+    '''
+    Levenberg-Marquardt fit of all the given spectra (shape (N, nz))
+    simultaneously. Each spectrum has its own damping parameter and is
+    dropped from the iterations once it has converged.
+    Returns (params, errors, reduced chi squared, success) arrays.
+    '''
+    valid = np.isfinite(spectra) & np.isfinite(sigma) & (sigma > 0)
+    weights = np.where(valid, 1 / np.where(valid, sigma, 1)**2, 0)
+    spectra = np.where(valid, spectra, 0)
+    p = _initial_guess(z, spectra, np.where(valid, sigma, np.inf), ncomponents)
+    nparams = p.shape[1]
+    damping = np.empty(len(p))
+    damping.fill(1e-3)
+    model, jacobian = _model_and_jacobian(z, p)
+    chi2 = (weights * (spectra - model)**2).sum(axis=1)
+    active = np.arange(len(p))
+    converged_or_stuck = np.zeros(len(p), dtype=bool)
+    identity = np.eye(nparams)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        w, r, J = weights[active], spectra[active] - model[active], jacobian[active]
+        alpha = np.einsum('nzp,nz,nzq->npq', J, w, J)
+        beta = np.einsum('nzp,nz->np', J, w*r)
+        diagonal = np.diagonal(alpha, axis1=1, axis2=2) + 1e-12
+        damped = alpha + (damping[active, None] * diagonal)[:, :, None] * identity
+        try:
+            step = np.linalg.solve(damped, beta[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError: # At least one matrix is singular
+            step = np.einsum('npq,nq->np', np.linalg.pinv(damped), beta)
+        trial = p[active] + step
+        trial[:, 2::3] = np.abs(trial[:, 2::3]) # widths must stay positive
+        trial_model, trial_jacobian = _model_and_jacobian(z, trial)
+        trial_chi2 = (w * (spectra[active] - trial_model)**2).sum(axis=1)
+        better = np.isfinite(trial_chi2) & (trial_chi2 <= chi2[active])
+        improved = active[better]
+        converged = better & ((chi2[active] - trial_chi2) <= tolerance * chi2[active])
+        p[improved], model[improved], jacobian[improved] = trial[better], trial_model[better], trial_jacobian[better]
+        chi2[improved] = trial_chi2[better]
+        damping[improved] /= 10
+        damping[active[~better]] *= 10
+        # Stop iterating on spectra that have converged, or where no step can improve the fit:
+        finished = converged | (damping[active] >= 1e10)
+        converged_or_stuck[active[finished]] = True
+        active = active[~finished]
+    # Uncertainties from the covariance matrix at the solution:
+    alpha = np.einsum('nzp,nz,nzq->npq', jacobian, weights, jacobian)
+    dof = np.maximum(valid.sum(axis=1) - nparams, 1)
+    errors = np.empty_like(p)
+    errors.fill(np.nan)
+    # Reject fits that ran out of iterations or wandered off to unphysical values:
+    with np.errstate(invalid='ignore'):
+        success = (converged_or_stuck & np.isfinite(p).all(axis=1) & np.isfinite(alpha).all(axis=(1, 2)) &
+                   (p[:, 0::3] > 0).all(axis=1) &
+                   (p[:, 1::3] >= 0).all(axis=1) & (p[:, 1::3] < z.size).all(axis=1) &
+                   (p[:, 2::3] < z.size).all(axis=1))
+    if success.any():
+        covariance = np.linalg.pinv(alpha[success])
+        errors[success] = np.sqrt(np.abs(np.diagonal(covariance, axis1=1, axis2=2)))
+        success[success] = np.isfinite(errors[success]).all(axis=1)
+    return p, errors, chi2 / dof, success
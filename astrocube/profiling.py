@@ -0,0 +1,166 @@
+'''
+astrocube.profiling: Lightweight timers and counters for the slow parts of
+astrocube (opening cubes, noise estimation, redrawing the viewer).
+
+Profiling is off by default, and then costs almost nothing. Turn it on by
+setting the environment variable ASTROCUBE_PROFILE=1, or by calling
+astrocube.profiling.enable(). Then call summary() to get a report, or
+export_trace(filename) to save a trace that can be loaded into
+chrome://tracing or https://ui.perfetto.dev
+
+If ASTROCUBE_PROFILE_TRACE is set to a file name, a trace is saved to that
+file when Python exits (and profiling is enabled automatically).
+
+@author: Braden MacDonald
+'''
+import atexit
+import os
+import threading
+import time
+
+_clock = getattr(time, "perf_counter", time.time) # perf_counter is Python 3.3+
+
+enabled = False
+_lock = threading.Lock()
+_start_time = _clock()
+_timings = {} # name -> [calls, total seconds, max seconds]
+_counters = {} # name -> value
+_events = [] # (name, start, duration, thread id) for the trace
+max_events = 1000000 # Stop recording trace events after this many, to bound memory use
+
+
+def enable():
+    ''' Start recording timings and counters '''
+    global enabled
+    enabled = True
+
+def disable():
+    ''' Stop recording (already recorded results are kept) '''
+    global enabled
+    enabled = False
+
+def reset():
+    ''' Discard everything recorded so far '''
+    global _start_time
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        del _events[:]
+        _start_time = _clock()
+
+
+class _Timer:
+    """ Context manager that records how long its block takes """
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = _clock()
+        return self
+    def __exit__(self, *exc_info):
+        duration = _clock() - self.start
+        with _lock:
+            timing = _timings.get(self.name)
+            if timing is None:
+                _timings[self.name] = [1, duration, duration]
+            else:
+                timing[0] += 1
+                timing[1] += duration
+                if duration > timing[2]:
+                    timing[2] = duration
+            if len(_events) < max_events:
+                _events.append((self.name, self.start, duration, threading.current_thread().ident))
+        return False
+
+class _NullTimer:
+    """ Used in place of _Timer when profiling is disabled """
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    '''
+    Returns a context manager which records the time taken by its block under
+    the given name, e.g.
+        with profiling.timer("DataCube.wcs"):
+            ...
+    '''
+    if not enabled:
+        return _null_timer
+    return _Timer(name)
+
+def timed(name):
+    ''' A decorator which records the time taken by each call of a function under the given name '''
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Timer(name):
+                return func(*args, **kwargs)
+        wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+        return wrapper
+    return decorator
+
+def count(name, n = 1):
+    ''' Add n to the counter with the given name '''
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def record_max(name, value):
+    ''' Record value in the named counter if it is larger than what's there (e.g. for peak memory use) '''
+    if not enabled:
+        return
+    with _lock:
+        if value > _counters.get(name, value - 1):
+            _counters[name] = value
+
+
+def timings():
+    ''' Returns a dict of name -> (calls, total seconds, max seconds) '''
+    with _lock:
+        return dict((name, tuple(t)) for name, t in _timings.items())
+
+def counters():
+    ''' Returns a dict of counter name -> value '''
+    with _lock:
+        return dict(_counters)
+
+def summary():
+    ''' Returns a plain-text report of all timings and counters '''
+    lines = ["{0:40s} {1:>8s} {2:>12s} {3:>12s} {4:>12s}".format("timer", "calls", "total (ms)", "mean (ms)", "max (ms)")]
+    for name, (calls, total, longest) in sorted(timings().items()):
+        lines.append("{0:40s} {1:8d} {2:12.3f} {3:12.3f} {4:12.3f}".format(name, calls, total*1000, total*1000/calls, longest*1000))
+    counter_values = counters()
+    if counter_values:
+        lines.append("")
+        lines.append("{0:40s} {1:>12s}".format("counter", "value"))
+        for name, value in sorted(counter_values.items()):
+            lines.append("{0:40s} {1:12}".format(name, value))
+    return "\n".join(lines)
+
+def export_trace(filename):
+    '''
+    Save the recorded timings as a JSON trace (Trace Event Format), which
+    can be opened in chrome://tracing or https://ui.perfetto.dev
+    '''
+    import json
+    pid = os.getpid()
+    with _lock:
+        trace_events = [{"name": name, "cat": "astrocube", "ph": "X", "pid": pid, "tid": tid,
+                         "ts": (start - _start_time)*1e6, "dur": duration*1e6}
+                        for name, start, duration, tid in _events]
+        end = (_clock() - _start_time)*1e6
+        for name, value in sorted(_counters.items()):
+            trace_events.append({"name": name, "cat": "astrocube", "ph": "C", "pid": pid, "ts": end, "args": {"value": value}})
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+if os.environ.get("ASTROCUBE_PROFILE", "0") not in ("", "0") or os.environ.get("ASTROCUBE_PROFILE_TRACE"):
+    enable()
+if os.environ.get("ASTROCUBE_PROFILE_TRACE"):
+    atexit.register(lambda: export_trace(os.environ["ASTROCUBE_PROFILE_TRACE"]))
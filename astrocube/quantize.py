@@ -0,0 +1,80 @@
+'''
+astrocube.quantize: Compact storage of data cubes as scaled 16-bit integers.
+
+The quantization step is chosen relative to the noise in the cube, so that
+the rounding error is a small fraction of the noise. Files written this way
+are ordinary FITS files (BITPIX = 16 with BSCALE/BZERO/BLANK), so they can
+be opened by DataCube, which gets float32 data back from PyFITS.
+
+@author: Braden MacDonald
+'''
+import gzip
+import warnings
+import numpy as np
+
+int16_min, int16_max = -32767, 32767 # Usable range; -32768 is reserved for BLANK (NaN)
+blank = -32768
+
+
+def quantization_step(noise_dev_xy, step_fraction = 0.1):
+    '''
+    Returns the quantization step to use: step_fraction times the smallest
+    positive, finite noise deviation. (A single step is needed for the whole
+    cube, as FITS only allows one BSCALE.)
+    '''
+    noise = np.asarray(noise_dev_xy)
+    noise = noise[np.isfinite(noise) & (noise > 0)]
+    if noise.size == 0:
+        raise Exception("The noise deviation of this cube is not valid, so it can't be used to quantize the data.")
+    return step_fraction * float(noise.min())
+
+
+def quantize(data, step):
+    '''
+    Returns (bscale, bzero) for storing data as 16-bit integers with the given
+    quantization step. If the range of the data is too large for that step,
+    a larger step is used and a warning is issued.
+    '''
+    dmin, dmax = float(np.nanmin(data)), float(np.nanmax(data))
+    bzero = (dmax + dmin) / 2
+    bscale = step
+    if (dmax - dmin) / bscale > (int16_max - int16_min):
+        bscale = (dmax - dmin) / (int16_max - int16_min)
+        warnings.warn("The data range is too large to quantize with a step of {0:.4g}; using {1:.4g} instead.".format(step, bscale))
+    return bscale, bzero
+
+
+def write_quantized(cube, filename, step_fraction = 0.1):
+    '''
+    Save the given DataCube as a FITS file of scaled 16-bit integers, with a
+    quantization step of step_fraction times the smallest noise deviation.
+    The original FITS axis order and header are kept. If filename ends in
+    ".gz", the file is gzip-compressed (quantized data compresses well).
+    Returns the quantization step (BSCALE) used.
+    '''
+    import pyfits
+    if cube.noise_dev_xy is None:
+        cube.calc_noise_dev()
+    bscale, bzero = quantize(cube.data, quantization_step(cube.noise_dev_xy, step_fraction))
+    # Undo the transpose done by DataCube, to get back to the FITS axis order:
+    fits_data = np.array(cube.data.transpose(np.argsort(cube._fits_axes)), dtype=np.float32)
+    nan_mask = np.isnan(fits_data)
+    fits_data[nan_mask] = bzero + blank*bscale # pyfits.scale() can't handle NaN, so map it to the BLANK value
+    header = cube._header.copy()
+    for keyword in ("BSCALE", "BZERO", "BLANK"):
+        if keyword in header:
+            del header[keyword]
+    hdu = pyfits.PrimaryHDU(fits_data, header)
+    hdu.scale('int16', bscale=bscale, bzero=bzero)
+    if nan_mask.any():
+        hdu.header.update('BLANK', blank)
+    hdu.header.add_history("Quantized by astrocube: step is {0} of the minimum noise deviation".format(step_fraction))
+    if filename.endswith(".gz"):
+        f = gzip.GzipFile(filename, "wb")
+        try:
+            hdu.writeto(f)
+        finally:
+            f.close()
+    else:
+        hdu.writeto(filename)
+    return bscale
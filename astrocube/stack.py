@@ -0,0 +1,201 @@
+'''
+astrocube.stack: Combine several data cubes (e.g. repeated observations of the
+same field, or different spectral lines) onto a common grid.
+
+@author: Braden MacDonald
+'''
+import numpy as np
+
+
+class CubeStacker:
+    """ Regrids a list of DataCubes onto the spatial/velocity grid of a
+        reference cube, and averages them together, weighting each cube by
+        the inverse variance of its noise (from noise_dev_xy).
+        The stack is computed a block of channels at a time, so neither the
+        regridded cubes nor the full stack ever need to be held in memory. """
+
+    def __init__(self, cubes, reference = None, weighting = "inverse_variance", block_size = 16):
+        '''
+        cubes: a list of DataCube objects to combine
+
+        reference: the DataCube whose grid the result will be on. Defaults to
+        the first cube. (It does not need to be one of the cubes being stacked.)
+
+        weighting: "inverse_variance" to weight each cube by 1/noise_dev_xy**2
+        (calc_noise_dev must have been called on each cube), or "uniform" for
+        a plain average
+
+        block_size: how many output channels to compute at once
+        '''
+        if not cubes:
+            raise Exception("At least one cube is needed to make a stack.")
+        if weighting not in ("inverse_variance", "uniform"):
+            raise ValueError("Invalid weighting '{0}'".format(weighting))
+        self.cubes = list(cubes)
+        self.reference = reference if reference is not None else self.cubes[0]
+        self.weighting = weighting
+        self.block_size = block_size
+        self.shape = self.reference.shape()
+        self._need_noise = (weighting == "inverse_variance")
+        self._grids = [self._grid_for(cube) for cube in self.cubes]
+
+    def _grid_for(self, cube):
+        '''
+        Work out where each pixel of the reference grid falls within the given
+        cube. Spatial and spectral axes are assumed to be independent (true for
+        any normal data cube), so this returns a spatial mapping (x, y arrays
+        with the reference's spatial shape) and a spectral mapping (a z array
+        with one entry per reference channel), all in fractional pixels of cube.
+        '''
+        nx, ny, nz = self.shape
+        ref = self.reference
+        if cube is ref:
+            x, y = np.mgrid[0:nx, 0:ny].astype(np.float_)
+            return _SourceGrid(cube, x, y, np.arange(nz, dtype=np.float_), self._need_noise)
+        if not (cube.has_coords and ref.has_coords):
+            # Without coordinates the only possible alignment is pixel-to-pixel:
+            if cube.shape() != self.shape:
+                raise Exception("Cubes without coordinate data can only be stacked with cubes of identical shape.")
+            x, y = np.mgrid[0:nx, 0:ny].astype(np.float_)
+            return _SourceGrid(cube, x, y, np.arange(nz, dtype=np.float_), self._need_noise)
+        ref_x, ref_y = np.mgrid[0:nx, 0:ny]
+        ra, dec, _ = ref.points_coords(ref_x, ref_y, 0)
+        vel0 = cube.point_coords(0, 0, 0)[2]
+        x, y, _ = cube.pixel_coords(ra, dec, vel0)
+        ref_vel = ref.points_coords(0, 0, np.arange(nz))[2]
+        ra0, dec0, _ = cube.point_coords(0, 0, 0)
+        z = cube.pixel_coords(ra0, dec0, ref_vel)[2]
+        return _SourceGrid(cube, x, y, z, self._need_noise)
+
+    def iter_blocks(self):
+        '''
+        A generator which computes the stack one block of channels at a time.
+        Yields tuples of (z_start, z_stop, data, noise) where data and noise
+        are arrays with shape (nx, ny, z_stop-z_start). noise is the standard
+        deviation of the noise in the stacked data. Pixels with no valid data
+        in any cube are NaN. (With uniform weighting, noise is also NaN
+        wherever any of the contributing cubes has no noise_dev_xy.)
+        '''
+        nx, ny, nz = self.shape
+        for z_start in range(0, nz, self.block_size):
+            z_stop = min(z_start + self.block_size, nz)
+            weighted_sum = np.zeros((nx, ny, z_stop - z_start))
+            weight_total = np.zeros_like(weighted_sum)
+            variance_sum = np.zeros_like(weighted_sum) # sum of weight**2 * noise**2
+            noise_missing = np.zeros(weighted_sum.shape, dtype=bool) # Some contributing cube has no noise estimate here
+            for grid in self._grids:
+                values = grid.regrid_channels(z_start, z_stop)
+                if values is None:
+                    continue # This cube doesn't cover these channels
+                if grid.noise_xy is None:
+                    sigma = np.empty(values.shape[:2] + (1,))
+                    sigma.fill(np.nan)
+                else:
+                    sigma = np.expand_dims(grid.noise_xy, 2)
+                sigma_ok = np.isfinite(sigma) & (sigma > 0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    if self.weighting == "inverse_variance":
+                        weights = np.where(np.isfinite(values) & sigma_ok, 1 / sigma**2, 0)
+                    else:
+                        weights = np.where(np.isfinite(values), 1.0, 0)
+                weighted_sum += np.where(weights > 0, values, 0) * weights
+                weight_total += weights
+                variance_sum += np.where((weights > 0) & sigma_ok, weights**2 * sigma**2, 0)
+                noise_missing |= (weights > 0) & ~sigma_ok
+            with np.errstate(invalid='ignore', divide='ignore'):
+                data = weighted_sum / weight_total
+                noise = np.sqrt(variance_sum) / weight_total
+            data[weight_total == 0] = np.nan
+            noise[(weight_total == 0) | noise_missing] = np.nan
+            yield z_start, z_stop, data, noise
+
+    def stack(self, out = None, noise_out = None):
+        '''
+        Compute the whole stack. The result is written into out (and the noise
+        into noise_out, if given), which may be numpy memmaps so that the
+        result goes straight to disk. If out is not given, a new array is
+        allocated. Returns out.
+        '''
+        if out is None:
+            out = np.empty(self.shape)
+        if out.shape != self.shape or (noise_out is not None and noise_out.shape != self.shape):
+            raise ValueError("Output arrays must have the shape of the reference cube, {0}".format(self.shape))
+        for z_start, z_stop, data, noise in self.iter_blocks():
+            out[:, :, z_start:z_stop] = data
+            if noise_out is not None:
+                noise_out[:, :, z_start:z_stop] = noise
+        return out
+
+
+def stack_cubes(cubes, reference = None, weighting = "inverse_variance", block_size = 16, out = None, noise_out = None):
+    '''
+    Shortcut for CubeStacker(cubes, reference, weighting, block_size).stack(out, noise_out)
+    '''
+    return CubeStacker(cubes, reference, weighting, block_size).stack(out, noise_out)
+
+
+class _SourceGrid:
+    """ Interpolates one source cube onto the reference grid (see CubeStacker._grid_for) """
+    def __init__(self, cube, x, y, z, need_noise):
+        if need_noise and cube.noise_dev_xy is None:
+            raise Exception("Inverse variance weighting needs the noise deviation of every cube. Call calc_noise_dev() first.")
+        self.cube = cube
+        self.z = z
+        sx, sy, self._nz = cube.shape()
+        # Precompute the bilinear interpolation indices and weights, since they are the same for every channel:
+        self._valid_xy = _in_range(x, sx) & _in_range(y, sy)
+        self._x0, self._x1, self._fx = _interp_indices(x, sx)
+        self._y0, self._y1, self._fy = _interp_indices(y, sy)
+        # The noise of this cube at each reference pixel (nearest neighbour), if known:
+        if cube.noise_dev_xy is None:
+            self.noise_xy = None
+        else:
+            nearest_x = np.clip(np.round(x), 0, sx-1).astype(int)
+            nearest_y = np.clip(np.round(y), 0, sy-1).astype(int)
+            self.noise_xy = np.where(self._valid_xy, np.asarray(cube.noise_dev_xy)[nearest_x, nearest_y], np.nan)
+
+    def _regrid_plane(self, plane):
+        ''' Bilinear interpolation of one channel of the source cube onto the reference spatial grid '''
+        x0, x1, fx, y0, y1, fy = self._x0, self._x1, self._fx, self._y0, self._y1, self._fy
+        result = (plane[x0, y0]*(1-fx)*(1-fy) + plane[x1, y0]*fx*(1-fy) +
+                  plane[x0, y1]*(1-fx)*fy + plane[x1, y1]*fx*fy)
+        result[~self._valid_xy] = np.nan
+        return result
+
+    def regrid_channels(self, z_start, z_stop):
+        '''
+        Returns the source cube interpolated onto reference channels
+        z_start..z_stop-1, or None if none of those channels are covered.
+        '''
+        z = self.z[z_start:z_stop]
+        valid_z = _in_range(z, self._nz)
+        if not valid_z.any():
+            return None
+        z0, z1, fz = _interp_indices(z, self._nz)
+        # Regrid each source channel that is needed exactly once:
+        planes = {}
+        for k in np.unique(np.concatenate([z0[valid_z], z1[valid_z]])):
+            planes[k] = self._regrid_plane(self.cube.data[:, :, k])
+        result = np.empty(self._valid_xy.shape + (len(z),))
+        for i in range(len(z)):
+            if valid_z[i]:
+                result[:, :, i] = planes[z0[i]]*(1-fz[i]) + planes[z1[i]]*fz[i]
+            else:
+                result[:, :, i] = np.nan
+        return result
+
+
+def _in_range(coord, size, tolerance = 1e-6):
+    ''' Which of the given fractional pixel coordinates fall within an axis of the given size '''
+    return np.isfinite(coord) & (coord >= -tolerance) & (coord <= size - 1 + tolerance)
+
+def _interp_indices(coord, size):
+    '''
+    For linear interpolation along an axis of the given size, returns the
+    indices of the pixels either side of each coordinate, and the fraction of
+    the way from the first to the second.
+    '''
+    coord = np.clip(np.nan_to_num(coord), 0, size-1)
+    i0 = np.minimum(np.floor(coord).astype(int), max(size-2, 0))
+    i1 = np.minimum(i0 + 1, size-1)
+    return i0, i1, coord - i0
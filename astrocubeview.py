@@ -8,11 +8,45 @@ Uses GTK as a widget library
 '''
 import os
 import sys
+
+
+def choose_fits_file(argv):
+    '''
+    Returns the name of the FITS file to open: the one given on the command
+    line, or else one chosen from those in the current directory.
+    '''
+    if len(argv) == 2:
+        return argv[1]
+    fits_files = [filename for filename in os.listdir('.') if (filename.endswith(".fits") and os.path.isfile(filename))]
+    if len(fits_files)==0:
+        print("No FITS files found in the current directory")
+        sys.exit(1)
+    print("Found {num} FITS files in the current directory:".format(num=len(fits_files)))
+    i=0
+    for f in fits_files:
+        print(" {id}:  {filename}".format(id=i,filename=f))
+        i+=1
+    choice = -1
+    while (choice < 0 or choice >= len(fits_files)):
+        choice = int(raw_input("\nWhich would you like to open? "))
+    return fits_files[choice]
+
+if __name__ == "__main__":
+    # Handle the command line before importing GTK and matplotlib, which are slow to import
+    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+        print("Usage: astrocubeview.py [FILE.fits]\n"
+              "       astrocubeview.py --info FILE.fits ...   (print a summary without opening the viewer)")
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--info":
+        from astrocube.__main__ import main
+        sys.exit(main(["info"] + sys.argv[2:]))
+    filename = choose_fits_file(sys.argv)
+
+
 import StringIO
 import gtk
 import numpy
 import matplotlib
-import pyfits
 from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg, NavigationToolbar2GTKAgg
 
 from astrocube import DataCube
@@ -167,26 +201,8 @@ class PlaceholderEntry(gtk.Entry):
 
 if __name__ == "__main__":
     
-    filename = False
-    if len(sys.argv) == 2:
-        filename = sys.argv[1]
-    else:
-        fits_files = [filename for filename in os.listdir('.') if (filename.endswith(".fits") and os.path.isfile(filename))]
-        if len(fits_files)==0:
-            print("No FITS files found in the current directory")
-            sys.exit(1)
-        print("Found {num} FITS files in the current directory:".format(num=len(fits_files)))
-        i=0
-        for f in fits_files:
-            print(" {id}:  {filename}".format(id=i,filename=f))
-            i+=1
-        choice = -1
-        while (choice < 0 or choice >= len(fits_files)):
-            choice = int(raw_input("\nWhich would you like to open? "))
-        filename = fits_files[choice]
-    
-    
-    # Now open the requested FITS file
+    # Now open the requested FITS file (filename was chosen at the top of this file)
+    import pyfits
     try:
         hdulist = pyfits.open(filename)
     except Exception as e:
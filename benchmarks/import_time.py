@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Checks that importing astrocube stays fast: it must not import any of the
+slow optional dependencies, and each import must stay within a fixed budget
+of time on top of importing numpy. Exits with status 1 if a budget is
+exceeded, so it can be run as part of a test or CI job.
+
+Usage:
+    python benchmarks/import_time.py [--budget-scale 1.0] [--repeats 10]
+
+(Use --budget-scale to allow more time on slow machines.)
+
+@author: Braden MacDonald
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which must not be imported by the given statements:
+heavy_modules = ["pywcs", "scipy", "pyfits", "gtk", "matplotlib"]
+# (statement, budget in milliseconds)
+checks = [
+    ("import astrocube", 25),
+    ("import astrocube.__main__", 40), # the headless command line interface
+    ("import astrocube.cache, astrocube.collection, astrocube.stack, astrocube.linefit, astrocube.lazy, astrocube.quantize", 100),
+]
+
+_timing_script = """
+import sys, time
+_clock = getattr(time, "perf_counter", time.time)
+import numpy
+start = _clock()
+{statement}
+elapsed = _clock() - start
+loaded = [m for m in {heavy!r} if m in sys.modules]
+print("%r %s" % (elapsed, ",".join(loaded)))
+"""
+
+def time_import(statement, repeats):
+    '''
+    Returns (seconds, heavy modules loaded): the fastest time taken by
+    statement over several fresh interpreters, after numpy has been imported.
+    '''
+    times = []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, "-c", _timing_script.format(statement=statement, heavy=heavy_modules)], cwd=root)
+        elapsed, _, loaded = output.decode("ascii").strip().partition(" ")
+        times.append(float(elapsed))
+    return min(times), [m for m in loaded.split(",") if m]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the import time budget of astrocube")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="multiply all of the time budgets by this")
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    failed = False
+    for statement, budget_ms in checks:
+        seconds, loaded = time_import(statement, args.repeats)
+        ok = seconds*1000 <= budget_ms*args.budget_scale and not loaded
+        failed = failed or not ok
+        print("{status:4s} {ms:8.1f} ms (budget {budget:.0f})  {stmt}{extra}".format(status="ok" if ok else "FAIL", ms=seconds*1000, budget=budget_ms*args.budget_scale, stmt=statement,
+              extra="  (imported {0})".format(", ".join(loaded)) if loaded else ""))
+    sys.exit(1 if failed else 0)
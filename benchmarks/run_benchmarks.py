@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the hot paths of astrocube, run on synthetic cubes.
+Runs headless (matplotlib's Agg backend is used in place of the GTK viewer).
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes small,medium --output results.json
+    python benchmarks/run_benchmarks.py --output new.json --compare old.json
+
+Each benchmark runs in a fresh process so that its peak memory use can be
+measured on its own.
+
+@author: Braden MacDonald
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Use the astrocube in this source tree
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+sizes = {
+    "small": (64, 64, 64),
+    "medium": (128, 128, 256),
+    "large": (256, 256, 512),
+}
+
+
+# Each benchmark is a function that takes a DataCube, does its setup, and
+# returns a function that runs the hot path once.
+
+def bench_calc_noise_dev(cube):
+    return lambda: cube.calc_noise_dev()
+
+def bench_mad(cube):
+    from astrocube import _mad
+    return lambda: _mad(cube.data, axis=2)
+
+def bench_point_coords(cube):
+    if not cube.has_coords:
+        return None
+    points = [(x, x, x) for x in range(min(cube.shape()))]
+    def run():
+        for x, y, z in points:
+            cube.point_coords(x, y, z)
+    return run
+
+def bench_points_coords(cube):
+    if not cube.has_coords:
+        return None
+    import numpy as np
+    x, y = np.mgrid[0:cube.shape()[0], 0:cube.shape()[1]]
+    return lambda: cube.points_coords(x, y, 0)
+
+def bench_slice_render(cube):
+    ''' What CubeViewWidget._check_redraw does when z changes: extract a slice and redraw the canvas '''
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import numpy as np
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    axes = fig.add_subplot(111)
+    imgplot = axes.imshow(cube.data[:,:,0].transpose(1,0), vmin=0, vmax=np.nanmax(cube.data))
+    fig.colorbar(imgplot)
+    nz = cube.shape()[2]
+    steps = list(range(0, nz, max(nz//20, 1)))
+    def run():
+        for z in steps:
+            imgplot.set_data(cube.data[:,:,z].transpose(1,0))
+            canvas.draw()
+    return run
+
+benchmarks = [
+    ("calc_noise_dev", bench_calc_noise_dev),
+    ("_mad", bench_mad),
+    ("point_coords", bench_point_coords),
+    ("points_coords", bench_points_coords),
+    ("slice_render", bench_slice_render),
+]
+
+
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # kilobytes on Linux
+
+def _run_one(args):
+    ''' Runs a single benchmark; called in a child process '''
+    name, size_name, with_wcs, repeats = args
+    import synthetic
+    from astrocube import DataCube
+    func = dict(benchmarks)[name]
+    cube = DataCube(synthetic.make_cube_hdu(sizes[size_name], with_wcs=with_wcs), calc_noise_dev=(name != "calc_noise_dev"))
+    run = func(cube)
+    if run is None:
+        return None # Not applicable to this kind of cube
+    try:
+        import tracemalloc # Python 3.4+; numpy reports its allocations to it
+    except ImportError:
+        tracemalloc = None
+    times = []
+    rss_before = _peak_rss_bytes()
+    if tracemalloc:
+        tracemalloc.start()
+    for _ in range(repeats):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    result = {"min_seconds": min(times), "mean_seconds": sum(times)/len(times), "repeats": repeats}
+    if tracemalloc:
+        result["peak_alloc_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    rss_after = _peak_rss_bytes()
+    if rss_before is not None:
+        result["peak_rss_increase_bytes"] = rss_after - rss_before
+    return result
+
+
+def run_all(size_names, repeats, only=None):
+    results = {}
+    for size_name in size_names:
+        for with_wcs in (True, False):
+            for name, _ in benchmarks:
+                if only and name not in only:
+                    continue
+                key = "{name}[{size}{wcs}]".format(name=name, size=size_name, wcs="" if with_wcs else ",no-wcs")
+                pool = multiprocessing.Pool(1, maxtasksperchild=1) # A fresh process for each benchmark
+                try:
+                    result = pool.apply(_run_one, ((name, size_name, with_wcs, repeats),))
+                finally:
+                    pool.close()
+                    pool.join()
+                if result is None:
+                    continue
+                result["shape"] = sizes[size_name]
+                results[key] = result
+                print("{key:40s} {t:10.4f} s".format(key=key, t=result["min_seconds"]))
+    return results
+
+
+def compare(old, new):
+    ''' Print a comparison of two sets of results '''
+    print("\n{0:40s} {1:>10s} {2:>10s} {3:>8s}".format("benchmark", "old (s)", "new (s)", "ratio"))
+    for key in sorted(set(old) & set(new)):
+        t_old, t_new = old[key]["min_seconds"], new[key]["min_seconds"]
+        print("{0:40s} {1:10.4f} {2:10.4f} {3:8.2f}".format(key, t_old, t_new, t_new/t_old if t_old else float("nan")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark astrocube on synthetic data cubes")
+    parser.add_argument("--sizes", default="small", help="comma-separated cube sizes: " + ", ".join(sorted(sizes)))
+    parser.add_argument("--repeats", type=int, default=3, help="how many times to run each benchmark")
+    parser.add_argument("--only", help="comma-separated names of benchmarks to run")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this earlier JSON file")
+    args = parser.parse_args()
+
+    import numpy
+    results = run_all(args.sizes.split(","), args.repeats, args.only.split(",") if args.only else None)
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)["results"], results)
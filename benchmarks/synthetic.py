@@ -0,0 +1,70 @@
+'''
+Generates synthetic data cubes for benchmarking (and experimenting with)
+astrocube: Gaussian sources on top of noise that varies across the field.
+
+@author: Braden MacDonald
+'''
+import numpy as np
+
+
+def make_cube_hdu(shape = (64, 64, 128), n_sources = 5, with_wcs = True, noise = 0.1, noise_gradient = 1.0, seed = 0):
+    '''
+    Returns a PyFITS PrimaryHDU containing a synthetic data cube.
+
+    shape: the (x, y, z) size of the cube, i.e. the shape of DataCube.data.
+    (With WCS, the FITS data array is stored in the reverse order, as usual.
+    Without WCS, DataCube doesn't re-order the axes, so it's stored as is.)
+
+    n_sources: how many 3-D Gaussian sources to inject
+
+    with_wcs: if True, the header has RA/DEC/VELO axes. Otherwise it only has
+    the OBJECT, LINENAME and NAXIS headers, like an artificial test cube.
+
+    noise, noise_gradient: the standard deviation of the noise is noise at
+    x=0 and rises linearly to noise*(1+noise_gradient) at the far x edge.
+
+    The injected sources are listed in the returned HDU's .sources attribute
+    as a list of dicts (amplitude, x, y, z, sigma_xy, sigma_z).
+    '''
+    import pyfits
+    data, sources = make_cube_data(shape, n_sources, noise, noise_gradient, seed)
+    hdu = pyfits.PrimaryHDU(data.transpose(2, 1, 0) if with_wcs else data)
+    header = hdu.header
+    header.update("OBJECT", "SYNTHETIC")
+    header.update("LINENAME", "FAKE")
+    if with_wcs:
+        nx, ny, nz = shape
+        for axis, (ctype, crval, cdelt, n) in enumerate([("RA---SIN", 52.25, -5.0/3600, nx),
+                                                         ("DEC--SIN", 31.0, 5.0/3600, ny),
+                                                         ("VELO-LSR", 4000.0, 100.0, nz)]):
+            header.update("CTYPE{0}".format(axis+1), ctype)
+            header.update("CRVAL{0}".format(axis+1), crval)
+            header.update("CDELT{0}".format(axis+1), cdelt)
+            header.update("CRPIX{0}".format(axis+1), (n+1)/2.0)
+        header.update("CUNIT3", "m/s")
+        header.update("EQUINOX", 2000.0)
+    hdu.sources = sources
+    return hdu
+
+
+def make_cube_data(shape = (64, 64, 128), n_sources = 5, noise = 0.1, noise_gradient = 1.0, seed = 0):
+    '''
+    Returns (data, sources): a float32 array with the given (x, y, z) shape
+    and a list describing the injected sources. See make_cube_hdu.
+    '''
+    random = np.random.RandomState(seed)
+    nx, ny, nz = shape
+    noise_xy = noise * (1 + noise_gradient * np.linspace(0, 1, nx))[:, None] * np.ones(ny)
+    data = (random.standard_normal(shape) * noise_xy[:, :, None]).astype(np.float32)
+    x, y, z = np.arange(nx), np.arange(ny), np.arange(nz)
+    sources = []
+    for _ in range(n_sources):
+        source = dict(amplitude=random.uniform(5, 50) * noise,
+                      x=random.uniform(0, nx), y=random.uniform(0, ny), z=random.uniform(0.2*nz, 0.8*nz),
+                      sigma_xy=random.uniform(1, max(nx, ny)/10.0), sigma_z=random.uniform(1, nz/20.0))
+        profile_x = np.exp(-(x - source["x"])**2 / (2*source["sigma_xy"]**2))
+        profile_y = np.exp(-(y - source["y"])**2 / (2*source["sigma_xy"]**2))
+        profile_z = np.exp(-(z - source["z"])**2 / (2*source["sigma_z"]**2))
+        data += (source["amplitude"] * profile_x[:, None, None] * profile_y[None, :, None] * profile_z[None, None, :]).astype(np.float32)
+        sources.append(source)
+    return data, sources
@@ -0,0 +1,87 @@
+'''
+Tests for astrocube.collection, with stand-ins for pyfits and pywcs whose
+behaviour depends on the file name: "hang*" files take forever to open, and
+"crash*" files kill the worker process.
+'''
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import types
+import unittest
+import numpy as np
+
+from astrocube.collection import CubeCollection
+
+
+class _FakeHDU:
+    def __init__(self, name):
+        self.header = {"NAXIS": 3, "OBJECT": name}
+        self.data = np.arange(4*5*6, dtype=np.float32).reshape(4, 5, 6)
+
+def _open(filename):
+    name = os.path.basename(filename)
+    if name.startswith("hang"):
+        time.sleep(60)
+    elif name.startswith("crash"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    return [_FakeHDU(name)]
+
+def _getheader(filename, hdu_index=0):
+    raise IOError("no memory estimates in these tests")
+
+class _FakeWCS:
+    """ A WCS without celestial coordinates """
+    def __init__(self, header):
+        self.wcs = self
+        self.lat = -1
+
+
+@unittest.skipUnless(hasattr(os, "fork") and multiprocessing.get_start_method() == "fork",
+                     "the fake pyfits module is only inherited by forked workers")
+class TestCubeCollection(unittest.TestCase):
+    def setUp(self):
+        self.saved_modules = dict((name, sys.modules.get(name)) for name in ("pyfits", "pywcs"))
+        sys.modules["pyfits"] = types.ModuleType("pyfits")
+        sys.modules["pyfits"].open, sys.modules["pyfits"].getheader = _open, _getheader
+        sys.modules["pywcs"] = types.ModuleType("pywcs")
+        sys.modules["pywcs"].WCS = _FakeWCS
+
+    def tearDown(self):
+        for name, module in self.saved_modules.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+    def run_collection(self, sources, **kwargs):
+        start = time.time()
+        results = CubeCollection(sources, calc_noise_dev=False, **kwargs).run()
+        return results, time.time() - start
+
+    def test_all_ok(self):
+        results, _ = self.run_collection(["ok1.fits", "ok2.fits", "ok3.fits"], processes=2)
+        self.assertEqual([r.ok for r in results], [True]*3)
+        self.assertEqual([r.summary["object_name"] for r in results], ["ok1.fits", "ok2.fits", "ok3.fits"])
+        self.assertEqual(results[0].summary["data_max"], 4*5*6 - 1)
+
+    def test_timeout_does_not_affect_queued_cubes(self):
+        # Both workers hang at first; the healthy cubes must wait for a free
+        # worker rather than time out in the queue.
+        results, elapsed = self.run_collection(["hang1.fits", "hang2.fits", "ok1.fits", "ok2.fits"], processes=2, timeout=1)
+        self.assertEqual([r.ok for r in results], [False, False, True, True])
+        for r in results[:2]:
+            self.assertIn("Timed out", r.error)
+        self.assertLess(elapsed, 30)
+
+    def test_worker_killed(self):
+        results, elapsed = self.run_collection(["crash1.fits", "ok1.fits", "crash2.fits", "ok2.fits"], processes=2)
+        self.assertEqual([r.ok for r in results], [False, True, False, True])
+        for r in results[0::2]:
+            self.assertIn("killed by signal {0}".format(signal.SIGKILL), r.error)
+        self.assertLess(elapsed, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
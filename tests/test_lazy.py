@@ -0,0 +1,66 @@
+'''
+Tests for astrocube.lazy: every result must match the same computation done
+with plain numpy arrays, however the expression is split into chunks.
+'''
+import unittest
+import warnings
+import numpy as np
+from astrocube.lazy import LazyArray, lazy
+
+
+class TestLazyArray(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.a = random.normal(size=(6, 7, 8))
+        self.a[self.a > 2] = np.nan
+        self.a[0, 0, :] = np.nan # An all-NaN spectrum
+        self.b = random.uniform(1, 2, size=(6, 7, 8))
+        self.noise = random.uniform(1, 2, size=(6, 7, 1))
+
+    def expressions(self):
+        ''' Yields (lazy expression, the same computed by numpy) '''
+        a, b, noise = self.a, self.b, self.noise
+        yield lazy(a) * b, a * b
+        yield b * lazy(a), b * a
+        yield lazy(a) - b[0, 0, :], a - b[0, 0, :]
+        yield (lazy(a) / lazy(noise) > 0.3) * lazy(a), (a / noise > 0.3) * a
+        yield abs(2 - lazy(a)) ** 2, abs(2 - a) ** 2
+        yield (lazy(b) > 1.5).where(lazy(a), b), np.where(b > 1.5, a, b)
+        yield (lazy(a) == lazy(a)) | (lazy(b) != 1.5), (a == a) | (b != 1.5)
+
+    def test_evaluate(self):
+        for expr, expected in self.expressions():
+            self.assertEqual(expr.shape, expected.shape)
+            self.assertEqual(expr.dtype, expected.dtype)
+            for chunk_bytes in (100, 1000, 5000, None):
+                for threads in (1, 3):
+                    result = expr.evaluate(chunk_bytes=chunk_bytes, threads=threads)
+                    self.assertTrue(np.array_equal(np.isnan(result), np.isnan(expected)))
+                    self.assertTrue(np.allclose(result, expected, equal_nan=True))
+            self.assertTrue(np.allclose(expr[3, :, 2:5], expected[3, :, 2:5], equal_nan=True))
+
+    def test_reductions(self):
+        names = ["sum", "nansum", "count_nonzero", "max", "min", "nanmax", "nanmin", "mean", "nanmean"]
+        with warnings.catch_warnings(): # numpy warns about the all-NaN spectrum
+            warnings.simplefilter("ignore")
+            for expr, expected in self.expressions():
+                for name in names:
+                    for axis in (None, 0, 1, 2, -1):
+                        numpy_result = getattr(np, name)(expected, axis=axis)
+                        for chunk_bytes in (100, 1000, 5000):
+                            result = getattr(expr, name)(axis=axis, chunk_bytes=chunk_bytes, threads=2)
+                            self.assertEqual(np.shape(result), np.shape(numpy_result), (name, axis))
+                            self.assertTrue(np.allclose(result, numpy_result, equal_nan=True), (name, axis))
+
+    def test_array_operand_is_sliced(self):
+        # Array operands must become leaves, not be kept whole in every chunk's computation:
+        expr = lazy(self.a) * self.b
+        self.assertTrue(isinstance(expr._args[1], LazyArray))
+        self.assertEqual(expr._index((slice(0, 1),))._args[1].shape, (1, 7, 8))
+
+    def test_unhashable(self):
+        self.assertRaises(TypeError, hash, lazy(self.a))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+'''
+Regression tests for astrocube.linefit, using synthetic spectra with known
+line parameters.
+'''
+import unittest
+import numpy as np
+from astrocube import linefit
+
+
+class _SyntheticCube:
+    """ Just enough of a DataCube (data and noise_dev) for fit_gaussians """
+    def __init__(self, data, noise):
+        self.data = data
+        self.noise_dev = np.empty_like(data)
+        self.noise_dev.fill(noise)
+
+
+class TestFitGaussians(unittest.TestCase):
+    components = [(1.0, 10.0, 2.0), (0.7, 45.0, 3.0)] # (amplitude, center, width) in channels
+    noise = 0.1
+
+    def make_cube(self, nx=8, ny=6, nz=60):
+        z = np.arange(nz)
+        spectrum = sum(a*np.exp(-(z - c)**2/(2*w**2)) for a, c, w in self.components)
+        random = np.random.RandomState(1234)
+        return _SyntheticCube(spectrum + random.normal(0, self.noise, (nx, ny, nz)), self.noise)
+
+    def test_two_components(self):
+        result = linefit.fit_gaussians(self.make_cube(), ncomponents=2, processes=1)
+        self.assertTrue(result.fitted.all())
+        for k, (amplitude, center, width) in enumerate(self.components):
+            self.assertAlmostEqual(np.median(result.amplitude[:, :, k]), amplitude, delta=0.05)
+            self.assertAlmostEqual(np.median(result.center[:, :, k]), center, delta=0.2)
+            self.assertAlmostEqual(np.median(result.width[:, :, k]), width, delta=0.2)
+            self.assertTrue(np.isfinite(result.center_err[:, :, k]).all())
+
+    def test_small_tiles(self):
+        # Each spectrum is fitted independently, so the tiling must not change the result:
+        cube = self.make_cube()
+        expected = linefit.fit_gaussians(cube, ncomponents=2, processes=1)
+        result = linefit.fit_gaussians(cube, ncomponents=2, processes=2, tile_size=5)
+        self.assertTrue(np.allclose(result.center, expected.center, equal_nan=True))
+
+
+if __name__ == "__main__":
+    unittest.main()